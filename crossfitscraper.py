@@ -1,74 +1,506 @@
-import requests
-from bs4 import BeautifulSoup
-from openai import OpenAI
+import argparse
+import asyncio
+import datetime
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import httpx
+from bs4 import BeautifulSoup, SoupStrainer
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
-# Load environment variables
-load_dotenv()
+# Helpers shared with scripts/reembed-workouts.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from embedding_cache import DEFAULT_CACHE_PATH, EmbeddingCache
+from ingest_telemetry import run_log_path, telemetry
+from page_cache import DEFAULT_PAGE_CACHE_PATH, PageCache
+from rate_limiter import RETRYABLE_STATUS, RateController, estimate_tokens
+from workout_index import KnownWorkouts, content_hash
+
+# Clients are created by init_clients() so importing this module has no side
+# effects; scripts/bench_ingest.py points them at local stand-ins instead.
+supabase: Client = None
+client: AsyncOpenAI = None
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+ARCHIVE_URL = "https://www.crossfit.com/workout/{year}?page={page}"
+
+# Marks the end of a stage's input queue
+_DONE = object()
+
+# Only the workout blocks of an archive page are built into a tree
+_WORKOUT_BLOCKS = SoupStrainer(class_="content")
+
+# Retries, backoff and adaptive concurrency for each remote service; their
+# concurrency ceilings are set from PipelineConfig by scrape_and_process()
+archive_limits = RateController("fetch")
+embedding_limits = RateController("embed")
+database_limits = RateController("db")
+
 
-# Supabase setup
-url: str = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
-key: str = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
-supabase: Client = create_client(url, key)
+@dataclass
+class PipelineConfig:
+    """Sizes and concurrency limits for each stage of the scrape pipeline"""
+    years: list = field(default_factory=lambda: [2020])
+    max_pages: int = 500
+    fetch_concurrency: int = 8
+    parse_concurrency: int = 2
+    embed_concurrency: int = 4
+    embed_batch_size: int = 64
+    write_concurrency: int = 2
+    write_batch_size: int = 100
+    queue_size: int = 256
+    batch_linger: float = 0.5
+    cache_path: str = DEFAULT_CACHE_PATH
+    page_cache_path: str = DEFAULT_PAGE_CACHE_PATH
+    # Parse in this many worker processes instead of threads
+    parse_processes: int = 0
+    # Re-extract workouts from the page cache without fetching anything
+    replay: bool = False
+    archive_url: str = ARCHIVE_URL
+    # Explicit embeddings limits; otherwise learned from response headers
+    requests_per_minute: int = None
+    tokens_per_minute: int = None
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-def get_embeddings(text):
-    response = client.embeddings.create(
-        input=text,
-        model="text-embedding-3-small"
+def init_clients():
+    """Create the Supabase and OpenAI clients from environment variables"""
+    global supabase, client
+    load_dotenv()
+    supabase = create_client(os.getenv("NEXT_PUBLIC_SUPABASE_URL"), os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY"))
+    client = AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=0,
+        http_client=httpx.AsyncClient(event_hooks=telemetry.async_httpx_hooks())
     )
-    embedding = response.data[0].embedding  
-    return embedding
-
-def insert_into_supabase(title, body, embedding):
-    # Check if the workout already exists
-    exists = supabase.table("external_workouts").select("id").eq("title", title).execute()
-    
-    if exists.data and len(exists.data) > 0:
-        print("Workout already exists, skipping insert.")
-        return
-    
-    # Proceed with the insert if the workout does not exist
-    data = {"title": title, "body": body, "embedding": embedding}
-    response = supabase.table("external_workouts").insert(data).execute()
-    
-    if hasattr(response, 'status_code') and response.status_code == 200:
-        print("Data inserted successfully")
-    else:
-        if hasattr(response, 'error'):
-            error = response.error() if callable(response.error) else response.error
-            print(f"Error inserting data: {error}")
-        else:
-            print("Failed to insert data, but no error information is available.")
-
-def scrape_and_process():
-    page = 1
-    while True:
-        url = f'https://www.crossfit.com/workout/2020?page={page}'
-        response = requests.get(url)
-        if response.status_code != 200:
-            break  
-
-        soup = BeautifulSoup(response.content, 'html.parser')
-        workout_elements = soup.find_all(class_='content')
-        if not workout_elements:
-            break  
-
-        for element in workout_elements:
-            if element.find('strong', text='Rest Day'):
-                continue  
-
-            title_element = element.find(class_='show')
-            if title_element:
-                title = title_element.get_text().strip()
-                body = element.get_text().strip() 
-                
-                embedding = get_embeddings(body)  
-                insert_into_supabase(title, body, embedding) 
-
-        page += 1  
-
-scrape_and_process()
+
+
+async def create_embeddings(texts):
+    """One embeddings API attempt, feeding the rate-limit headers to embedding_limits"""
+    with telemetry.timed("embed", inputs=len(texts), request_chars=sum(len(t) for t in texts)) as stats:
+        raw = await client.embeddings.with_raw_response.create(
+            input=texts,
+            model=EMBEDDING_MODEL
+        )
+        embedding_limits.observe(raw.headers)
+        response = raw.parse()
+        stats["tokens"] = response.usage.total_tokens if response.usage else 0
+        stats["response_bytes"] = sum(len(item.embedding) for item in response.data) * 4
+    return response
+
+
+async def request_embeddings(texts):
+    """Embed a list of texts in one call, returned in input order"""
+    response = await embedding_limits.call_async(create_embeddings, texts, tokens=estimate_tokens(texts))
+    embeddings = [None] * len(texts)
+    for item in response.data:
+        embeddings[item.index] = item.embedding
+    return embeddings
+
+
+async def get_embeddings(texts, cache=None):
+    """Embed texts, only calling the API for those missing from `cache`.
+
+    Cache reads and writes run in a thread so SQLite stays off the event loop.
+    """
+    if cache is None:
+        return await request_embeddings(texts)
+
+    embeddings, missing = await asyncio.to_thread(cache.lookup, texts, EMBEDDING_MODEL)
+    if missing:
+        fresh = await request_embeddings([texts[i] for i in missing])
+        await asyncio.to_thread(cache.fill, texts, embeddings, missing, fresh, EMBEDDING_MODEL)
+    return embeddings
+
+
+def insert_into_supabase(rows):
+    """Bulk insert workouts, letting the content_hash unique index drop duplicates"""
+    with telemetry.timed("db_write", rows=len(rows)) as stats:
+        response = supabase.table("external_workouts").upsert(
+            rows,
+            on_conflict="content_hash",
+            ignore_duplicates=True,
+            returning="minimal",
+            count="exact"
+        ).execute()
+        inserted = response.count if response.count is not None else len(rows)
+        stats["inserted"] = inserted
+    telemetry.count("rows_written", inserted)
+    print(f"Inserted {inserted} workouts")
+    return inserted
+
+
+def replace_in_supabase(rows):
+    """Overwrite stored workouts by ID with re-extracted content and embeddings"""
+    with telemetry.timed("db_write", rows=len(rows)):
+        supabase.table("external_workouts").upsert(
+            rows,
+            on_conflict="id",
+            returning="minimal"
+        ).execute()
+    telemetry.count("rows_written", len(rows))
+    print(f"Replaced {len(rows)} workouts")
+    return len(rows)
+
+
+async def fetch_page(http, url, pages=None):
+    """Fetch an archive page, returning (status, body).
+
+    With a page cache the request is conditional on the stored copy, and a
+    304 comes back with the cached body. Raises on statuses worth retrying.
+    """
+    headers = pages.validators(url) if pages is not None else {}
+    with telemetry.timed("fetch") as stats:
+        response = await http.get(url, headers=headers)
+        stats["bytes"] = len(response.content)
+        stats["status"] = str(response.status_code)
+    if response.status_code in RETRYABLE_STATUS:
+        response.raise_for_status()
+    if pages is None:
+        return response.status_code, response.content
+
+    if response.status_code == 304:
+        body = await asyncio.to_thread(pages.get, url)
+        if body is not None:
+            telemetry.count("pages_not_modified")
+            await asyncio.to_thread(pages.touch, url)
+            return 304, body
+    elif response.status_code == 200:
+        await asyncio.to_thread(
+            pages.put, url, response.content,
+            response.headers.get("etag"), response.headers.get("last-modified")
+        )
+    return response.status_code, response.content
+
+
+def parse_workouts(html):
+    """Extract (title, body) pairs from an archive page.
+
+    Also returns the number of .content blocks on the page, rest days and
+    untitled blocks included; a page with none is past the end of the archive.
+    """
+    soup = BeautifulSoup(html, 'html.parser', parse_only=_WORKOUT_BLOCKS)
+    blocks = soup.find_all(class_='content')
+    workouts = []
+    for element in blocks:
+        if element.find('strong', text='Rest Day'):
+            continue
+
+        title_element = element.find(class_='show')
+        if title_element:
+            title = title_element.get_text().strip()
+            body = element.get_text().strip()
+            workouts.append((title, body))
+    return workouts, len(blocks)
+
+
+async def _next_batch(queue, batch_size, linger):
+    """Take up to `batch_size` items from `queue`.
+
+    Waits for the first item, then at most `linger` seconds for the batch to
+    fill. Returns the batch and whether the end-of-input marker was seen.
+    """
+    item = await queue.get()
+    if item is _DONE:
+        return [], True
+
+    batch = [item]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + linger
+    while len(batch) < batch_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            item = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+        if item is _DONE:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+async def _run_stage(workers, downstream=None, downstream_workers=0):
+    """Wait for a stage's workers, then signal end of input downstream"""
+    await asyncio.gather(*workers)
+    if downstream is not None:
+        for _ in range(downstream_workers):
+            await downstream.put(_DONE)
+
+
+async def scrape_and_process(config=None):
+    """Crawl the archive and store embedded workouts.
+
+    Fetch, parse, embed and write run as separate stages joined by bounded
+    queues, so a slow stage holds back the ones feeding it.
+    """
+    config = config or PipelineConfig()
+    archive_limits.configure(concurrency=config.fetch_concurrency)
+    embedding_limits.configure(
+        concurrency=config.embed_concurrency,
+        requests_per_minute=config.requests_per_minute,
+        tokens_per_minute=config.tokens_per_minute
+    )
+    database_limits.configure(concurrency=config.write_concurrency)
+    cache = EmbeddingCache(config.cache_path) if config.cache_path else None
+    pages = PageCache(config.page_cache_path) if config.page_cache_path else None
+    if config.replay and pages is None:
+        raise ValueError("Replaying needs a page cache")
+    parse_pool = ProcessPoolExecutor(config.parse_processes) if config.parse_processes else None
+    parse_workers = max(config.parse_concurrency, config.parse_processes)
+    with telemetry.timed("index_load") as index_stats:
+        known = await database_limits.call_async(asyncio.to_thread, KnownWorkouts.load, supabase)
+        index_stats["hashes"] = len(known.hashes)
+
+    page_queue = asyncio.Queue(maxsize=config.fetch_concurrency)
+    html_queue = asyncio.Queue(maxsize=config.queue_size)
+    workout_queue = asyncio.Queue(maxsize=config.queue_size)
+    row_queue = asyncio.Queue(maxsize=config.queue_size)
+
+    # First page number found to be past the end of each year's archive
+    year_end = {}
+    stats = {"pages": 0, "unchanged": 0, "workouts": 0, "skipped": 0, "embedded": 0, "inserted": 0,
+             "replaced": 0, "errors": 0}
+
+    def past_end(year, page):
+        return year in year_end and page >= year_end[year]
+
+    def mark_end(year, page):
+        year_end[year] = min(page, year_end.get(year, page))
+
+    async def produce_pages():
+        for year in config.years:
+            for page in range(1, config.max_pages + 1):
+                if past_end(year, page):
+                    break
+                await page_queue.put((year, page))
+        for _ in range(config.fetch_concurrency):
+            await page_queue.put(_DONE)
+
+    async def fetch_pages(http):
+        while True:
+            item = await page_queue.get()
+            if item is _DONE:
+                return
+            year, page = item
+            if past_end(year, page):
+                continue
+            url = config.archive_url.format(year=year, page=page)
+            if config.replay:
+                html = await asyncio.to_thread(pages.get, url)
+                if html is None:
+                    mark_end(year, page)
+                    continue
+            else:
+                try:
+                    status, html = await archive_limits.call_async(fetch_page, http, url, pages)
+                except httpx.HTTPError as e:
+                    print(f"Error fetching {year} page {page}: {e}")
+                    stats["errors"] += 1
+                    continue
+                if status == 304:
+                    stats["unchanged"] += 1
+                elif status != 200:
+                    mark_end(year, page)
+                    continue
+            stats["pages"] += 1
+            await html_queue.put((year, page, html))
+
+    async def parse_pages():
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await html_queue.get()
+            if item is _DONE:
+                return
+            year, page, html = item
+            if past_end(year, page):
+                continue
+            try:
+                with telemetry.timed("parse", bytes=len(html)) as parse_stats:
+                    workouts, blocks = await loop.run_in_executor(parse_pool, parse_workouts, html)
+                    parse_stats["workouts"] = len(workouts)
+            except Exception as e:
+                print(f"Error parsing {year} page {page}: {e}")
+                stats["errors"] += 1
+                continue
+            if not blocks:
+                mark_end(year, page)
+                continue
+            stats["workouts"] += len(workouts)
+            for title, body in workouts:
+                digest = content_hash(title, body)
+                if config.replay:
+                    store, row_id = known.claim_replacement(title, digest)
+                else:
+                    store, row_id = known.claim(title, digest), None
+                if not store:
+                    stats["skipped"] += 1
+                    telemetry.count("rows_skipped")
+                    continue
+                await workout_queue.put((title, body, digest, row_id))
+
+    async def embed_workouts():
+        done = False
+        while not done:
+            batch, done = await _next_batch(workout_queue, config.embed_batch_size, config.batch_linger)
+            if not batch:
+                continue
+            try:
+                embeddings = await get_embeddings([body for _, body, _, _ in batch], cache)
+            except Exception as e:
+                print(f"Error embedding batch of {len(batch)}: {e}")
+                stats["errors"] += len(batch)
+                continue
+            stats["embedded"] += len(batch)
+            for (title, body, digest, row_id), embedding in zip(batch, embeddings):
+                row = {
+                    "title": title,
+                    "body": body,
+                    "content_hash": digest,
+                    "embedding": embedding
+                }
+                if row_id is not None:
+                    row["id"] = row_id
+                await row_queue.put(row)
+
+    async def write_rows():
+        done = False
+        while not done:
+            batch, done = await _next_batch(row_queue, config.write_batch_size, config.batch_linger)
+            if not batch:
+                continue
+            new_rows = [row for row in batch if "id" not in row]
+            replacements = [row for row in batch if "id" in row]
+            if new_rows:
+                try:
+                    inserted = await database_limits.call_async(asyncio.to_thread, insert_into_supabase, new_rows)
+                except Exception as e:
+                    print(f"Error inserting batch of {len(new_rows)}: {e}")
+                    stats["errors"] += len(new_rows)
+                else:
+                    stats["inserted"] += inserted
+            if replacements:
+                try:
+                    replaced = await database_limits.call_async(asyncio.to_thread, replace_in_supabase, replacements)
+                except Exception as e:
+                    print(f"Error replacing batch of {len(replacements)}: {e}")
+                    stats["errors"] += len(replacements)
+                else:
+                    stats["replaced"] += replaced
+
+    limits = httpx.Limits(
+        max_connections=config.fetch_concurrency,
+        max_keepalive_connections=config.fetch_concurrency
+    )
+    async with httpx.AsyncClient(limits=limits, timeout=30.0, follow_redirects=True,
+                                 event_hooks=telemetry.async_httpx_hooks()) as http:
+        await asyncio.gather(
+            produce_pages(),
+            _run_stage(
+                [fetch_pages(http) for _ in range(config.fetch_concurrency)],
+                html_queue, parse_workers
+            ),
+            _run_stage(
+                [parse_pages() for _ in range(parse_workers)],
+                workout_queue, config.embed_concurrency
+            ),
+            _run_stage(
+                [embed_workouts() for _ in range(config.embed_concurrency)],
+                row_queue, config.write_concurrency
+            ),
+            _run_stage([write_rows() for _ in range(config.write_concurrency)]),
+        )
+
+    if parse_pool is not None:
+        parse_pool.shutdown()
+    if pages is not None:
+        pages.close()
+    if cache is not None:
+        stats["cache_hits"] = cache.hits
+        telemetry.count("cache_hits", cache.hits)
+        telemetry.count("cache_misses", cache.misses)
+        cache.close()
+    return stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scrape the CrossFit workout archive into Supabase")
+    parser.add_argument("--start-year", type=int, default=2020)
+    parser.add_argument("--end-year", type=int, default=None,
+                        help="Last year to crawl (defaults to --start-year)")
+    parser.add_argument("--max-pages", type=int, default=500,
+                        help="Upper bound on pages crawled per year")
+    parser.add_argument("--fetch-concurrency", type=int, default=8)
+    parser.add_argument("--parse-concurrency", type=int, default=2)
+    parser.add_argument("--parse-processes", type=int, default=0,
+                        help="Parse pages in this many worker processes instead of threads")
+    parser.add_argument("--embed-concurrency", type=int, default=4)
+    parser.add_argument("--embed-batch-size", type=int, default=64)
+    parser.add_argument("--write-concurrency", type=int, default=2)
+    parser.add_argument("--write-batch-size", type=int, default=100)
+    parser.add_argument("--queue-size", type=int, default=256,
+                        help="Capacity of each queue between stages")
+    parser.add_argument("--requests-per-minute", type=int, default=None,
+                        help="Cap on embeddings requests per minute (otherwise learned from response headers)")
+    parser.add_argument("--tokens-per-minute", type=int, default=None,
+                        help="Cap on embedding tokens per minute (otherwise learned from response headers)")
+    parser.add_argument("--cache-path", default=DEFAULT_CACHE_PATH,
+                        help="SQLite file holding previously computed embeddings")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always call the embeddings API")
+    parser.add_argument("--page-cache-path", default=DEFAULT_PAGE_CACHE_PATH,
+                        help="SQLite file holding crawled archive pages")
+    parser.add_argument("--no-page-cache", action="store_true",
+                        help="Neither store pages nor send conditional requests")
+    parser.add_argument("--replay", action="store_true",
+                        help="Re-extract workouts from the page cache without fetching anything. Stored "
+                             "workouts whose extracted content changed are updated in place (matched by "
+                             "title), unchanged ones are skipped and new ones inserted")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    init_clients()
+    telemetry.open(run_log_path("scrape_telemetry"))
+    end_year = args.end_year or args.start_year
+    config = PipelineConfig(
+        years=list(range(args.start_year, end_year + 1)),
+        max_pages=args.max_pages,
+        fetch_concurrency=args.fetch_concurrency,
+        parse_concurrency=args.parse_concurrency,
+        parse_processes=args.parse_processes,
+        embed_concurrency=args.embed_concurrency,
+        embed_batch_size=args.embed_batch_size,
+        write_concurrency=args.write_concurrency,
+        write_batch_size=args.write_batch_size,
+        queue_size=args.queue_size,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        cache_path=None if args.no_cache else args.cache_path,
+        page_cache_path=None if args.no_page_cache else args.page_cache_path,
+        replay=args.replay,
+    )
+
+    started = datetime.datetime.now()
+    stats = asyncio.run(scrape_and_process(config))
+    elapsed = (datetime.datetime.now() - started).total_seconds()
+
+    print(f"{'Replayed' if config.replay else 'Fetched'} {stats['pages']} pages, parsed {stats['workouts']} workouts "
+          f"({stats['skipped']} already stored), embedded {stats['embedded']}, inserted {stats['inserted']}, "
+          f"replaced {stats['replaced']} "
+          f"({stats['errors']} errors) in {elapsed:.1f}s")
+    if stats["unchanged"]:
+        print(f"{stats['unchanged']} of {stats['pages']} pages were unchanged since the last crawl")
+    if "cache_hits" in stats:
+        print(f"Embedding cache served {stats['cache_hits']} of {stats['embedded']} embeddings")
+    print(telemetry.finish())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,598 @@
+"""Offline throughput benchmark for crossfitscraper.py and reembed-workouts.py.
+
+Starts three local stand-ins on 127.0.0.1 and points both ingest pipelines
+at them, so runs are repeatable on any Linux box without network access:
+
+- an OpenAI-compatible /v1/embeddings endpoint returning deterministic
+  vectors, with configurable latency and 429 rate
+- a PostgREST-compatible table store (select/filter/order/limit, count,
+  insert and upsert with on_conflict) behind a Supabase-shaped URL
+- a crossfit.com-style archive server, serving saved pages from a directory
+  (<year>-<page>.html) or synthetic pages, with ETags and 304 responses to
+  conditional requests
+
+The scraper crawls the fake archive into external_workouts, then the
+re-embed script copies those rows into external_workouts_new. For each
+pipeline the report gives rows/sec, API and database calls per row,
+p50/p99 latency per service and peak memory (each pipeline runs in its own
+forked process, so peaks don't accumulate). --min-*-rows-per-sec turn it
+into a CI regression check.
+
+Usage:
+    python scripts/bench_ingest.py
+    python scripts/bench_ingest.py --years 3 --pages 40 --embed-latency 0.2 --rate-429 0.05
+    python scripts/bench_ingest.py --pages-dir saved_pages --json bench.json
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(SCRIPTS_DIR)
+
+
+class Recorder:
+    """Thread-safe call counts and latencies per service endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.counts = Counter()
+
+    def record(self, endpoint, seconds, **counts):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.counts[endpoint] += 1
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def reset(self):
+        with self._lock:
+            self.latencies.clear()
+            self.counts.clear()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None, content_type="application/json"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null")
+
+
+def _start(handler, **attrs):
+    """Serve `handler` (subclassed with `attrs`) on an ephemeral port"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), type("Handler", (handler,), attrs))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def fake_embedding(text, dimensions):
+    """Deterministic pseudo-embedding of `text`"""
+    raw = array("b", hashlib.shake_256(text.encode("utf-8")).digest(dimensions))
+    return [value / 128 for value in raw]
+
+
+class EmbeddingsHandler(_Handler):
+    """OpenAI /v1/embeddings stand-in"""
+    recorder = None
+    latency = 0.0
+    rate_429 = 0.0
+    dimensions = 1536
+    rng = None
+    rng_lock = threading.Lock()
+
+    def do_POST(self):
+        started = time.perf_counter()
+        request = self._json_body()
+        time.sleep(self.latency)
+
+        with self.rng_lock:
+            throttled = self.rng.random() < self.rate_429
+        if throttled:
+            self.recorder.record("embeddings", time.perf_counter() - started, embeddings_429=1)
+            self._send(429, json.dumps({"error": {
+                "message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"
+            }}), {"retry-after-ms": "20"})
+            return
+
+        texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        dimensions = request.get("dimensions") or self.dimensions
+        data = []
+        for i, text in enumerate(texts):
+            vector = fake_embedding(text, dimensions)
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        body = json.dumps({
+            "object": "list",
+            "data": data,
+            "model": request.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+        self._send(200, body, {
+            "x-ratelimit-limit-requests": "5000",
+            "x-ratelimit-remaining-requests": "4999",
+            "x-ratelimit-limit-tokens": "5000000",
+            "x-ratelimit-remaining-tokens": str(5000000 - tokens),
+            "x-ratelimit-reset-requests": "12ms",
+            "x-ratelimit-reset-tokens": "0s",
+        })
+        self.recorder.record("embeddings", time.perf_counter() - started,
+                             embedding_inputs=len(texts), embedding_tokens=tokens)
+
+
+class PostgrestStore:
+    """In-memory tables with the subset of PostgREST semantics the scripts use"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = defaultdict(dict)
+        self.next_id = defaultdict(lambda: 1)
+
+    def insert(self, table, rows, on_conflict="id", resolution=None):
+        """Insert rows; returns (inserted_or_updated_rows, conflict_error)"""
+        with self.lock:
+            store = self.tables[table]
+            existing = {}
+            if on_conflict != "id":
+                existing = {row.get(on_conflict): row_id for row_id, row in store.items()
+                            if row.get(on_conflict) is not None}
+            written = []
+            for row in rows:
+                row = dict(row)
+                if "id" not in row or row["id"] is None:
+                    row["id"] = self.next_id[table]
+                self.next_id[table] = max(self.next_id[table], row["id"] + 1)
+                key = row.get(on_conflict)
+                match = key if on_conflict == "id" and key in store else existing.get(key) if key is not None else None
+                if match is not None:
+                    if resolution == "ignore-duplicates":
+                        continue
+                    if resolution != "merge-duplicates":
+                        return [], f"duplicate key value violates unique constraint on {on_conflict}"
+                    row["id"] = match
+                    row = {**store[match], **row}
+                store[row["id"]] = row
+                if on_conflict != "id" and key is not None:
+                    existing[key] = row["id"]
+                written.append(row)
+            return written, None
+
+    def select(self, table, params):
+        filters = []
+        for column, expression in params:
+            if column in ("select", "order", "limit", "offset", "columns", "on_conflict"):
+                continue
+            op, _, value = expression.partition(".")
+            filters.append((column, op, value))
+
+        def matches(row):
+            for column, op, value in filters:
+                field = row.get(column)
+                if op == "in":
+                    if str(field) not in value.strip("()").split(","):
+                        return False
+                elif op == "eq":
+                    if str(field) != value:
+                        return False
+                elif field is None:
+                    return False
+                else:
+                    target = type(field)(value) if isinstance(field, (int, float)) else value
+                    if not {"gt": field > target, "gte": field >= target,
+                            "lt": field < target, "lte": field <= target}[op]:
+                        return False
+            return True
+
+        query = dict(params)
+        with self.lock:
+            rows = [row for row in self.tables[table].values() if matches(row)]
+        if "order" in query:
+            column, _, direction = query["order"].partition(".")
+            rows.sort(key=lambda row: row.get(column) or 0, reverse=direction.startswith("desc"))
+        total = len(rows)
+        offset = int(query.get("offset", 0))
+        if "limit" in query:
+            rows = rows[offset:offset + int(query["limit"])]
+        else:
+            rows = rows[offset:]
+        columns = query.get("select", "*")
+        if columns != "*":
+            names = columns.split(",")
+            rows = [{name: row.get(name) for name in names} for row in rows]
+        return rows, total
+
+
+class PostgrestHandler(_Handler):
+    """Supabase REST (/rest/v1) stand-in backed by a PostgrestStore"""
+    recorder = None
+    store = None
+    latency = 0.0
+
+    def _route(self):
+        parts = urlsplit(self.path)
+        return parts.path.removeprefix("/rest/v1/"), parse_qsl(parts.query, keep_blank_values=True)
+
+    def _prefer(self):
+        return dict(
+            item.strip().partition("=")[::2] for item in (self.headers.get("Prefer") or "").split(",") if item
+        )
+
+    def do_GET(self):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        table, params = self._route()
+        rows, total = self.store.select(table, params)
+        headers = {}
+        if self._prefer().get("count"):
+            headers["Content-Range"] = f"0-{max(len(rows) - 1, 0)}/{total}"
+        self._send(200, json.dumps(rows), headers)
+        self.recorder.record("postgrest.read", time.perf_counter() - started, db_rows_read=len(rows))
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        table, params = self._route()
+        body = self._json_body()
+        if table.startswith("rpc/"):
+            self._send(200, "null")
+            self.recorder.record("postgrest.rpc", time.perf_counter() - started)
+            return
+
+        rows = body if isinstance(body, list) else [body]
+        prefer = self._prefer()
+        written, error = self.store.insert(
+            table, rows, dict(params).get("on_conflict") or "id", prefer.get("resolution")
+        )
+        if error:
+            self._send(409, json.dumps({"code": "23505", "message": error, "details": None, "hint": None}))
+            self.recorder.record("postgrest.write", time.perf_counter() - started, db_write_conflicts=1)
+            return
+        headers = {"Content-Range": f"*/{len(written)}"} if prefer.get("count") else {}
+        if prefer.get("return") == "representation":
+            self._send(201, json.dumps(written), headers)
+        else:
+            self._send(201, b"", headers)
+        self.recorder.record("postgrest.write", time.perf_counter() - started, db_rows_written=len(written))
+
+
+class ArchiveHandler(_Handler):
+    """crossfit.com /workout/<year>?page=N stand-in"""
+    recorder = None
+    pages_dir = None
+    pages_per_year = 10
+    workouts_per_page = 10
+    latency = 0.0
+
+    # Roughly the size of the navigation, scripts and footer around the
+    # workout list on a real archive page
+    FILLER = "<div class='nav'>" + "<a href='#'>link</a>" * 600 + "</div>"
+
+    def _synthetic_page(self, year, page):
+        blocks = []
+        for i in range(self.workouts_per_page):
+            day = (page - 1) * self.workouts_per_page + i
+            if day % 7 == 6:
+                blocks.append(f"<div class='content'><h3 class='show'>{year}{day:04d}</h3>"
+                              f"<p><strong>Rest Day</strong></p></div>")
+                continue
+            rounds = 3 + day % 5
+            blocks.append(
+                f"<div class='content'><h3 class='show'>{year}{day:04d}</h3>"
+                f"<p>{rounds} rounds for time of:</p>"
+                f"<p>{10 + day % 11} pull-ups<br>{15 + day % 9} push-ups<br>{20 + day % 13} squats</p>"
+                f"<p>Post time to comments. Workout {year}-{day}.</p></div>"
+            )
+        return f"<html><body>{self.FILLER}{''.join(blocks)}{self.FILLER}</body></html>"
+
+    def do_GET(self):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        parts = urlsplit(self.path)
+        year = parts.path.rstrip("/").rsplit("/", 1)[-1]
+        page = int(dict(parse_qsl(parts.query)).get("page", 1))
+
+        body = None
+        if self.pages_dir:
+            path = os.path.join(self.pages_dir, f"{year}-{page}.html")
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    body = f.read()
+        elif year.isdigit() and page <= self.pages_per_year:
+            body = self._synthetic_page(int(year), page)
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if body is None:
+            self._send(404, "not found", content_type="text/html")
+        else:
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+            validators = {"ETag": etag, "Last-Modified": "Sat, 01 Jan 2022 00:00:00 GMT"}
+            if self.headers.get("If-None-Match") == etag:
+                body = b""
+                self._send(304, body, validators)
+            else:
+                self._send(200, body, validators, content_type="text/html; charset=utf-8")
+        self.recorder.record("archive", time.perf_counter() - started,
+                             page_bytes=len(body) if body else 0)
+
+
+def load_pipelines():
+    """Import both ingest scripts without running them"""
+    sys.path.insert(0, REPO_ROOT)
+    import crossfitscraper
+
+    spec = importlib.util.spec_from_file_location(
+        "reembed_workouts", os.path.join(SCRIPTS_DIR, "reembed-workouts.py")
+    )
+    reembed = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(reembed)
+    return crossfitscraper, reembed
+
+
+class _MemoryPeak:
+    """Peak memory of a block: tracemalloc when enabled, else process max RSS.
+
+    Max RSS only ever grows, so it is only meaningful inside a process that
+    runs a single pipeline; see _run_pipeline().
+    """
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.peak_mb = 0.0
+
+    def __enter__(self):
+        if self.trace:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            tracemalloc.stop()
+        else:
+            self.peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_pipeline(run, trace_memory, output):
+    """Run `run()` in a forked child process and time it there.
+
+    Each pipeline gets its own process so its peak RSS doesn't include the
+    pipelines before it. The stand-in servers stay in this process. Returns
+    the elapsed seconds, peak MB and the child's telemetry counters and stages.
+    """
+    from ingest_telemetry import telemetry
+
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+
+    def child():
+        try:
+            telemetry.reset()
+            with output, _MemoryPeak(trace_memory) as memory:
+                started = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - started
+            sender.send((elapsed, memory.peak_mb, dict(telemetry.counters), dict(telemetry.stages)))
+        except BaseException as e:
+            sender.send(RuntimeError(f"{type(e).__name__}: {e}"))
+
+    process = context.Process(target=child)
+    process.start()
+    # Only the child holds the sending end, so recv() sees EOF if it dies
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError(f"Pipeline process exited with code {process.exitcode} without reporting results")
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def _summarize(name, rows, elapsed, recorder, peak_mb, counters, stages):
+    counts = recorder.counts
+    per_row = max(rows, 1)
+    return {
+        "pipeline": name,
+        "rows": rows,
+        "seconds": elapsed,
+        "rows_per_sec": rows / elapsed if elapsed else 0.0,
+        "embedding_calls_per_row": counts["embeddings"] / per_row,
+        "db_calls_per_row": (counts["postgrest.read"] + counts["postgrest.write"] + counts["postgrest.rpc"]) / per_row,
+        "page_fetches": counts["archive"],
+        "embedding_429s": counts["embeddings_429"],
+        "embedding_tokens": counts["embedding_tokens"],
+        "peak_memory_mb": peak_mb,
+        "latency_ms": {
+            endpoint: {
+                "count": len(values),
+                "p50": percentile(values, 50) * 1000,
+                "p99": percentile(values, 99) * 1000,
+            }
+            for endpoint, values in sorted(recorder.latencies.items())
+        },
+        # Client-side view from ingest_telemetry, including queueing and sleeps
+        "backoff_seconds": counters.get("backoff_seconds", 0.0),
+        "stage_ms": {
+            stage: {
+                "count": histogram.count,
+                "p50": histogram.percentile(50),
+                "p99": histogram.percentile(99),
+            }
+            for stage, histogram in sorted(stages.items())
+        },
+    }
+
+
+def run_benchmark(args):
+    recorder = Recorder()
+    store = PostgrestStore()
+    embeddings, embeddings_url = _start(
+        EmbeddingsHandler, recorder=recorder, latency=args.embed_latency,
+        rate_429=args.rate_429, rng=random.Random(args.seed)
+    )
+    postgrest, postgrest_url = _start(PostgrestHandler, recorder=recorder, store=store, latency=args.db_latency)
+    archive, archive_url = _start(
+        ArchiveHandler, recorder=recorder, pages_dir=args.pages_dir, pages_per_year=args.pages,
+        workouts_per_page=args.workouts_per_page, latency=args.page_latency
+    )
+
+    from openai import AsyncOpenAI, OpenAI
+    from supabase import create_client
+
+    crossfitscraper, reembed = load_pipelines()
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        crossfitscraper.supabase = create_client(postgrest_url, "bench-key")
+        crossfitscraper.client = AsyncOpenAI(api_key="bench", base_url=f"{embeddings_url}/v1", max_retries=0)
+        config = crossfitscraper.PipelineConfig(
+            years=list(range(2020, 2020 + args.years)),
+            max_pages=args.pages + 1,
+            cache_path=None,
+            page_cache_path=os.path.join(workdir, "pages.sqlite3"),
+            archive_url=archive_url + "/workout/{year}?page={page}",
+        )
+        recorder.reset()
+        measured = _run_pipeline(
+            lambda: asyncio.run(crossfitscraper.scrape_and_process(config)), args.trace_memory, output
+        )
+        results.append(_summarize("scrape", len(store.tables["external_workouts"]), measured[0], recorder, *measured[1:]))
+
+        reembed.supabase = create_client(postgrest_url, "bench-key")
+        reembed.openai_client = OpenAI(api_key="bench", base_url=f"{embeddings_url}/v1", max_retries=0)
+
+        def run_reembed():
+            checkpoint = reembed.ReembedCheckpoint(os.path.join(workdir, "checkpoint.sqlite3"))
+            reembed.reembed_workouts(
+                page_size=args.reembed_page_size,
+                batch_size=args.reembed_batch_size,
+                rate_limit_delay=args.reembed_delay,
+                concurrency=args.reembed_concurrency,
+                checkpoint=checkpoint,
+            )
+            checkpoint.close()
+
+        recorder.reset()
+        measured = _run_pipeline(run_reembed, args.trace_memory, output)
+        results.append(_summarize("reembed", len(store.tables["external_workouts_new"]), measured[0], recorder, *measured[1:]))
+
+    for server in (embeddings, postgrest, archive):
+        server.shutdown()
+    return results
+
+
+def print_report(results):
+    print(f"{'pipeline':<9} {'rows':>6} {'secs':>7} {'rows/s':>8} {'embed/row':>9} {'db/row':>7} "
+          f"{'pages':>6} {'429s':>5} {'peak MB':>8}")
+    for r in results:
+        print(f"{r['pipeline']:<9} {r['rows']:>6} {r['seconds']:>7.2f} {r['rows_per_sec']:>8.1f} "
+              f"{r['embedding_calls_per_row']:>9.3f} {r['db_calls_per_row']:>7.3f} "
+              f"{r['page_fetches']:>6} {r['embedding_429s']:>5} {r['peak_memory_mb']:>8.1f}")
+    print()
+    print(f"{'pipeline':<9} {'service':<16} {'calls':>6} {'p50 ms':>8} {'p99 ms':>8}")
+    for r in results:
+        for endpoint, stats in r["latency_ms"].items():
+            print(f"{r['pipeline']:<9} {endpoint:<16} {stats['count']:>6} {stats['p50']:>8.1f} {stats['p99']:>8.1f}")
+    print()
+    print(f"{'pipeline':<9} {'client stage':<16} {'calls':>6} {'p50 ms':>8} {'p99 ms':>8}")
+    for r in results:
+        for stage, stats in r["stage_ms"].items():
+            print(f"{r['pipeline']:<9} {stage:<16} {stats['count']:>6} {stats['p50']:>8.1f} {stats['p99']:>8.1f}")
+        print(f"{r['pipeline']:<9} {'backoff/sleeps':<16} {'':>6} {r['backoff_seconds'] * 1000:>8.0f} total")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest scripts against local stand-in services")
+    parser.add_argument("--years", type=int, default=2, help="Archive years to crawl")
+    parser.add_argument("--pages", type=int, default=10, help="Synthetic pages per year")
+    parser.add_argument("--workouts-per-page", type=int, default=10)
+    parser.add_argument("--pages-dir", help="Serve saved archive pages named <year>-<page>.html instead")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="Seconds per embeddings request")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of embeddings requests throttled")
+    parser.add_argument("--db-latency", type=float, default=0.01, help="Seconds per PostgREST request")
+    parser.add_argument("--page-latency", type=float, default=0.05, help="Seconds per archive page")
+    parser.add_argument("--reembed-page-size", type=int, default=100)
+    parser.add_argument("--reembed-batch-size", type=int, default=50)
+    parser.add_argument("--reembed-delay", type=float, default=0.0,
+                        help="rate_limit_delay passed to reembed_workouts()")
+    parser.add_argument("--reembed-concurrency", type=int, default=4,
+                        help="concurrency passed to reembed_workouts()")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Measure peak Python allocations per pipeline (slower)")
+    parser.add_argument("--json", help="Also write results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the scripts' own output")
+    parser.add_argument("--min-scrape-rows-per-sec", type=float, default=0.0)
+    parser.add_argument("--min-reembed-rows-per-sec", type=float, default=0.0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run_benchmark(args)
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    minimums = {"scrape": args.min_scrape_rows_per_sec, "reembed": args.min_reembed_rows_per_sec}
+    failed = [r for r in results if r["rows_per_sec"] < minimums[r["pipeline"]]]
+    for r in failed:
+        print(f"FAIL: {r['pipeline']} ran at {r['rows_per_sec']:.1f} rows/s, "
+              f"below the {minimums[r['pipeline']]:.1f} rows/s minimum", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Persistent on-disk cache for OpenAI embeddings.
+
+Shared by crossfitscraper.py and scripts/reembed-workouts.py so that
+re-running either script only pays for texts it has not embedded before.
+Entries are keyed by (model, dimensions, sha256 of the normalized text) and
+vectors are stored as float32 blobs in a single SQLite file. When the cache
+grows past `max_bytes` the least recently used entries are evicted.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ".cache",
+    "embeddings.sqlite3"
+)
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Evict down to this fraction of max_bytes so eviction doesn't run on every put
+_EVICT_TARGET = 0.9
+
+
+def normalize_text(text):
+    """Canonical form of `text` used for cache keys"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(text, model, dimensions=None):
+    """Content address for an embedding of `text`"""
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{model}:{dimensions or 0}:{digest}"
+
+
+class EmbeddingCache:
+    """Size-bounded, content-addressed embedding store"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def get_many(self, texts, model, dimensions=None):
+        """Look up `texts`, returning a list of vectors with None for misses"""
+        keys = [cache_key(text, model, dimensions) for text in texts]
+        found = {}
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, k) for k in found]
+                )
+                self._conn.commit()
+
+        vectors = [None if found.get(k) is None else array("f", found[k]).tolist() for k in keys]
+        hits = sum(vector is not None for vector in vectors)
+        # Callers may look up from several threads at once
+        with self._lock:
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return vectors
+
+    def put_many(self, texts, vectors, model, dimensions=None):
+        """Store embeddings for `texts`, evicting old entries if over budget"""
+        now = time.time()
+        unique = {}
+        for text, vector in zip(texts, vectors):
+            blob = array("f", vector).tobytes()
+            k = cache_key(text, model, dimensions)
+            unique[k] = (k, blob, len(blob), now)
+        rows = list(unique.values())
+
+        with self._lock:
+            replaced = 0
+            for start in range(0, len(rows), 500):
+                chunk = [row[0] for row in rows[start:start + 500]]
+                placeholders = ",".join("?" * len(chunk))
+                replaced += self._conn.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchone()[0]
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._total_bytes += sum(row[2] for row in rows) - replaced
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until under the eviction target"""
+        target = int(self.max_bytes * _EVICT_TARGET)
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            victims = []
+            for k, size in rows:
+                victims.append((k,))
+                self._total_bytes -= size
+                if self._total_bytes <= target:
+                    break
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+            self.evictions += len(victims)
+
+    def lookup(self, texts, model, dimensions=None):
+        """Cached vectors for `texts` (None for misses) and the indexes of the misses"""
+        vectors = self.get_many(texts, model, dimensions)
+        return vectors, [i for i, vector in enumerate(vectors) if vector is None]
+
+    def fill(self, texts, vectors, missing, fresh, model, dimensions=None):
+        """Store `fresh` vectors for the `missing` texts and merge them into `vectors`"""
+        self.put_many([texts[i] for i in missing], fresh, model, dimensions)
+        for i, vector in zip(missing, fresh):
+            vectors[i] = vector
+        return vectors
+
+    def embed(self, texts, model, dimensions, embed_fn):
+        """Return embeddings for `texts`, calling `embed_fn` only for misses.
+
+        `embed_fn` takes a list of texts and returns their vectors in order.
+        Async callers use lookup() and fill() around their own API call.
+        """
+        vectors, missing = self.lookup(texts, model, dimensions)
+        if missing:
+            self.fill(texts, vectors, missing, embed_fn([texts[i] for i in missing]), model, dimensions)
+        return vectors
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes": self._total_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
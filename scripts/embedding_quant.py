@@ -0,0 +1,41 @@
+"""Compact encodings for stored embeddings.
+
+Used by reembed-workouts.py to write reduced-dimension, half-precision and
+int8 variants next to (or instead of) the full float32 vector. The numpy
+versions in workout_similarity.py apply the same scheme when measuring
+recall, so benchmark numbers describe what is actually stored.
+"""
+import math
+import struct
+
+
+def truncate_dimensions(vector, dimensions):
+    """Keep the first `dimensions` values and re-normalize to unit length.
+
+    text-embedding-3 vectors are trained so that a normalized prefix is
+    equivalent to requesting fewer dimensions from the API.
+    """
+    prefix = vector[:dimensions]
+    norm = math.sqrt(sum(x * x for x in prefix)) or 1.0
+    return [x / norm for x in prefix]
+
+
+def to_half(vector):
+    """Round values to the nearest float16, as stored in a halfvec column"""
+    packed = struct.pack(f"<{len(vector)}e", *vector)
+    return list(struct.unpack(f"<{len(vector)}e", packed))
+
+
+def quantize_int8(vector):
+    """Symmetric per-vector int8 quantization.
+
+    Returns (codes, scale) with codes in [-127, 127] and
+    vector ~= [code * scale for code in codes].
+    """
+    scale = max((abs(x) for x in vector), default=0.0) / 127 or 1.0
+    return [max(-127, min(127, round(x / scale))) for x in vector], scale
+
+
+def int8_to_bytea(codes):
+    """Encode int8 codes as a Postgres bytea hex literal for PostgREST"""
+    return "\\x" + bytes(code & 0xFF for code in codes).hex()
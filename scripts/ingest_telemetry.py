@@ -0,0 +1,234 @@
+"""Buffered, structured run telemetry for the ingest scripts.
+
+crossfitscraper.py and reembed-workouts.py record per-stage timings,
+payload sizes, token counts, retries, rate-limit responses and time spent
+sleeping through a module-level Telemetry instance. Events are kept in
+memory and appended to a JSON lines file every `flush_interval` seconds,
+when the buffer fills, and at exit. Latencies also go into log-bucketed
+histograms so the end-of-run summary can show percentiles per stage
+without keeping every sample.
+"""
+import atexit
+import datetime
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+LOGS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "logs")
+
+# Histogram buckets grow by 10% so percentiles are accurate to about 5%
+_BUCKET_BASE = 1.1
+
+
+def run_log_path(name):
+    """Timestamped JSON lines path in the repo's logs directory"""
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(LOGS_DIR, f"{name}_{timestamp}.jsonl")
+
+
+class LatencyHistogram:
+    """Log-bucketed latency distribution in milliseconds"""
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.buckets[math.floor(math.log(max(ms, 0.001), _BUCKET_BASE))] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # Upper edge of the bucket, capped at the largest sample
+                return min(_BUCKET_BASE ** (bucket + 1), self.max)
+        return self.max
+
+
+class Telemetry:
+    """Counters, stage histograms and a buffered JSON lines event log.
+
+    With no `path` nothing is written to disk, but counters and histograms
+    are still kept so the summary (and scripts/bench_ingest.py) can use them.
+    """
+
+    def __init__(self, path=None, flush_interval=5.0, max_buffer=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.counters = Counter()
+        self.stages = defaultdict(LatencyHistogram)
+        self.started = time.perf_counter()
+        self._buffer = []
+        self._file = None
+        self._last_flush = time.monotonic()
+        self._flush_callbacks = []
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def open(self, path):
+        """Start writing events to `path`, keeping anything recorded so far"""
+        with self._lock:
+            self.path = path
+            self.started = time.perf_counter()
+
+    def reset(self):
+        """Clear counters and histograms, e.g. between benchmark runs"""
+        with self._lock:
+            self.counters.clear()
+            self.stages.clear()
+            self.started = time.perf_counter()
+
+    def event(self, kind, **fields):
+        fields["ts"] = round(time.time(), 3)
+        fields["kind"] = kind
+        with self._lock:
+            self._buffer.append(fields)
+            due = (len(self._buffer) >= self.max_buffer
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def on_flush(self, callback):
+        """Also call `callback` on every flush, e.g. to flush a text log"""
+        self._flush_callbacks.append(callback)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def record(self, stage, seconds, **counts):
+        """Record one completed operation of `stage` plus any counts it carried"""
+        ms = seconds * 1000
+        with self._lock:
+            self.stages[stage].add(ms)
+            for name, value in counts.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.counters[f"{stage}.{name}"] += value
+        self.event("stage", stage=stage, ms=round(ms, 3), **counts)
+
+    @contextmanager
+    def timed(self, stage, **counts):
+        """Time a block as one `stage` operation.
+
+        Yields a dict the block can add counts to (rows, bytes, ...). A
+        block that raises is recorded with error=True.
+        """
+        started = time.perf_counter()
+        try:
+            yield counts
+        except BaseException:
+            counts["error"] = True
+            self.count(f"{stage}.errors")
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - started, **counts)
+
+    def backoff(self, seconds, reason):
+        """Record time deliberately spent sleeping"""
+        with self._lock:
+            self.counters["backoff_seconds"] += seconds
+            self.counters[f"backoff.{reason}"] += seconds
+        self.event("backoff", reason=reason, seconds=round(seconds, 3))
+
+    def sleep(self, seconds, reason):
+        if seconds > 0:
+            self.backoff(seconds, reason)
+            time.sleep(seconds)
+
+    def log(self, level, message):
+        self.event("log", level=level, message=message)
+
+    def _count_response(self, response):
+        self.count(f"http.{response.request.url.host}.{response.status_code}")
+        if response.status_code == 429:
+            self.count("rate_limited")
+        elif response.status_code >= 500:
+            self.count("server_errors")
+
+    def httpx_hooks(self):
+        """Event hooks for an httpx.Client, counting every response by status"""
+        return {"response": [self._count_response]}
+
+    def async_httpx_hooks(self):
+        """Event hooks for an httpx.AsyncClient"""
+        async def count_response(response):
+            self._count_response(response)
+        return {"response": [count_response]}
+
+    def flush(self):
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+            if buffer and self.path:
+                if self._file is None:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                    self._file = open(self.path, "a")
+                self._file.write("".join(json.dumps(event, default=str) + "\n" for event in buffer))
+                self._file.flush()
+        for callback in self._flush_callbacks:
+            callback()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def summary(self, rows_counter="rows_written"):
+        """Human-readable end-of-run report"""
+        elapsed = time.perf_counter() - self.started
+        rows = self.counters.get(rows_counter, 0)
+        backoff = self.counters.get("backoff_seconds", 0.0)
+        lines = [
+            f"Run time {elapsed:.1f}s, {rows} rows written ({rows / elapsed if elapsed else 0:.1f} rows/s), "
+            f"{backoff:.1f}s ({backoff / elapsed * 100 if elapsed else 0:.0f}%) spent in backoff/sleeps",
+            f"{'stage':<14} {'calls':>7} {'total s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}",
+        ]
+        for stage, histogram in sorted(self.stages.items()):
+            lines.append(
+                f"{stage:<14} {histogram.count:>7} {histogram.total / 1000:>8.2f} "
+                f"{histogram.percentile(50):>8.1f} {histogram.percentile(90):>8.1f} "
+                f"{histogram.percentile(99):>8.1f} {histogram.max:>8.1f}"
+            )
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"  {name}: {round(value, 3) if isinstance(value, float) else value}")
+        return "\n".join(lines)
+
+    def finish(self, rows_counter="rows_written"):
+        """Log the summary as a final event, flush, and return it"""
+        text = self.summary(rows_counter)
+        self.event(
+            "summary",
+            seconds=round(time.perf_counter() - self.started, 3),
+            counters=dict(self.counters),
+            stages={
+                stage: {
+                    "count": h.count,
+                    "total_ms": round(h.total, 3),
+                    "p50_ms": round(h.percentile(50), 3),
+                    "p99_ms": round(h.percentile(99), 3),
+                }
+                for stage, h in self.stages.items()
+            },
+        )
+        self.flush()
+        return text
+
+
+# Shared by whichever ingest script imported this module
+telemetry = Telemetry()
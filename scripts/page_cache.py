@@ -0,0 +1,92 @@
+"""Persistent cache of crawled archive pages.
+
+crossfitscraper.py stores every archive page it downloads here, keyed by
+URL, with the body zlib-compressed alongside its ETag and Last-Modified
+validators. Later crawls send those validators as If-None-Match /
+If-Modified-Since so unchanged pages come back as empty 304s, and
+--replay re-parses the stored pages without touching the network.
+"""
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+DEFAULT_PAGE_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ".cache",
+    "archive_pages.sqlite3"
+)
+
+
+class PageCache:
+    """URL-keyed store of compressed page bodies and their validators.
+
+    Safe to use from several threads. A 304 should `touch` the entry rather
+    than `put` it again, so the stored body and validators stay as they were.
+    """
+
+    def __init__(self, path=DEFAULT_PAGE_CACHE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+
+    def validators(self, url):
+        """Conditional request headers for the cached copy of `url`, if any"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers["If-None-Match"] = row[0]
+        if row and row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def get(self, url):
+        """The cached body of `url`, or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT body FROM pages WHERE url = ?", (url,)).fetchone()
+        return zlib.decompress(row[0]) if row else None
+
+    def put(self, url, body, etag=None, last_modified=None):
+        compressed = zlib.compress(body, 6)
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO pages (url, body, etag, last_modified, size, fetched_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (url, compressed, etag, last_modified, len(body), time.time())
+            )
+            self._conn.commit()
+
+    def touch(self, url):
+        """Note that `url` was revalidated without changes"""
+        with self._lock:
+            self._conn.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), url))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            pages, raw, stored = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(body)), 0) FROM pages"
+            ).fetchone()
+        return {"pages": pages, "bytes": raw, "compressed_bytes": stored}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,329 @@
+"""Adaptive rate limiting and retries for calls to remote services.
+
+crossfitscraper.py and reembed-workouts.py route every archive fetch,
+embeddings request and database call through a RateController for that
+service. A controller combines:
+
+- token buckets for requests and tokens per minute, sized from explicit
+  limits and/or the x-ratelimit-* headers the OpenAI API returns, so calls
+  wait only when the account's budget is actually spent;
+- AIMD concurrency: the number of calls allowed in flight grows by about
+  one per window of successful calls and halves when the service throttles
+  or fails, at most once per window;
+- retries with full-jitter exponential backoff on 429s, 5xx responses,
+  timeouts and connection errors, honouring Retry-After. A 429 pauses every
+  caller sharing the controller, not just the one that received it.
+
+The OpenAI clients are created with max_retries=0 so that retries happen
+here, where they are visible to the limiter and to telemetry.
+"""
+import asyncio
+import email.utils
+import random
+import re
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import httpx
+import openai
+
+from ingest_telemetry import telemetry
+
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# Postgres/PostgREST errors worth retrying: serialization failure, deadlock,
+# too many connections, statement timeout, and PostgREST losing its pool
+RETRYABLE_PG_CODES = {"40001", "40P01", "53300", "57014", "PGRST000", "PGRST001", "PGRST002", "PGRST003"}
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+    """Seconds in an x-ratelimit-reset-* value such as "6m0s" or "120ms" """
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_SECONDS[unit] for number, unit in parts)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(headers):
+    """Seconds the server asked us to wait, from Retry-After(-ms) headers"""
+    if not headers:
+        return None
+    milliseconds = _number(headers.get("retry-after-ms"))
+    if milliseconds is not None:
+        return milliseconds / 1000
+    value = headers.get("retry-after")
+    seconds = _number(value)
+    if seconds is not None or not value:
+        return seconds
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(texts):
+    """Rough token count of embedding inputs, for reserving TPM budget"""
+    return sum(len(text) for text in texts) // 4 + len(texts)
+
+
+def _status(exc):
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        response = getattr(exc, "response", None)
+        status = getattr(response, "status_code", None)
+    return status
+
+
+def is_retryable(exc):
+    """Whether `exc` is a transient failure that's worth retrying"""
+    if isinstance(exc, (httpx.TransportError, openai.APIConnectionError)):
+        return True
+    status = _status(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # postgrest.APIError: a Postgres/PostgREST code, or the HTTP status when
+    # the response body wasn't JSON (e.g. a 502 from the gateway)
+    code = getattr(exc, "code", None)
+    if code is None:
+        return False
+    if str(code).isdigit() and len(str(code)) == 3:
+        return int(code) in RETRYABLE_STATUS
+    return str(code) in RETRYABLE_PG_CODES
+
+
+class TokenBucket:
+    """Budget of `limit` units per minute, refilled continuously.
+
+    Reservations may take the level below zero; the caller then waits for
+    the debt to refill. With no limit configured or observed yet the bucket
+    never waits.
+    """
+
+    def __init__(self, limit=None):
+        self.configured = limit
+        self.observed = None
+        self.level = float("inf")
+        self.updated = time.monotonic()
+
+    @property
+    def capacity(self):
+        limits = [limit for limit in (self.configured, self.observed) if limit]
+        return min(limits) if limits else None
+
+    def _refill(self, now):
+        capacity = self.capacity
+        if capacity:
+            self.level = min(capacity, self.level + (now - self.updated) * capacity / 60)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Take `amount` units, returning the seconds to wait before using them"""
+        capacity = self.capacity
+        if not capacity:
+            return 0.0
+        self._refill(now)
+        self.level -= min(amount, capacity)
+        return max(0.0, -self.level * 60 / capacity)
+
+    def observe(self, limit, remaining, now):
+        """Adopt the server's view of the limit and what's left of it"""
+        if limit:
+            self.observed = limit
+        if remaining is not None and self.capacity:
+            self._refill(now)
+            self.level = min(self.level, remaining)
+
+
+class RateController:
+    """Rate limits, adaptive concurrency and retries for one service.
+
+    Use `call(fn, *args, **kwargs)` from threads or
+    `await call_async(fn, *args, **kwargs)` from asyncio code; `tokens`
+    is the number of tokens the call will consume. `concurrency` is both
+    the starting and the maximum number of calls in flight.
+
+    Share one controller between everything that talks to a service: the
+    limits, the in-flight count and any 429 pause apply across all of its
+    callers, whether pipeline workers or threads. A pipeline stage therefore
+    slows down on its own while its service is throttling.
+    """
+
+    def __init__(self, name, concurrency=4, min_concurrency=1, requests_per_minute=None,
+                 tokens_per_minute=None, max_retries=6, base_delay=0.5, max_delay=60.0):
+        self.name = name
+        self.max_concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(concurrency)
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def configure(self, concurrency=None, requests_per_minute=None, tokens_per_minute=None):
+        """Change the concurrency ceiling and any explicit per-minute limits"""
+        with self._cond:
+            if concurrency:
+                self.max_concurrency = concurrency
+                self.limit = float(concurrency)
+            if requests_per_minute:
+                self.requests.configured = requests_per_minute
+            if tokens_per_minute:
+                self.tokens.configured = tokens_per_minute
+
+    def observe(self, headers):
+        """Feed x-ratelimit-* response headers into the buckets"""
+        now = time.monotonic()
+        with self._cond:
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                remaining = _number(headers.get(f"x-ratelimit-remaining-{kind}"))
+                bucket.observe(_number(headers.get(f"x-ratelimit-limit-{kind}")), remaining, now)
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if remaining is not None and remaining <= 0 and reset:
+                    self._paused_until = max(self._paused_until, now + reset)
+
+    def _reserve(self, tokens):
+        now = time.monotonic()
+        with self._cond:
+            return max(
+                self._paused_until - now,
+                self.requests.reserve(1, now),
+                self.tokens.reserve(tokens, now),
+            )
+
+    def _succeeded(self):
+        with self._cond:
+            # Additive increase: about +1 per `limit` successful calls
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def _retry_delay(self, exc, attempt, started):
+        """Seconds to wait before retrying after `exc`, or None to give up"""
+        if not is_retryable(exc):
+            return None
+        response = getattr(exc, "response", None)
+        headers = getattr(response, "headers", None)
+        if headers:
+            self.observe(headers)
+        now = time.monotonic()
+        with self._cond:
+            # Multiplicative decrease, once per window: failures of calls that
+            # started before the last decrease were already accounted for
+            decreased = started >= self._last_decrease
+            if decreased:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self._last_decrease = now
+        if decreased:
+            telemetry.event("concurrency", service=self.name, limit=round(self.limit, 2))
+        if attempt >= self.max_retries:
+            telemetry.count(f"{self.name}.gave_up")
+            return None
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hint = retry_after(headers)
+        if hint is not None:
+            delay = max(delay, min(hint, self.max_delay))
+        if _status(exc) == 429:
+            # Everyone sharing this controller holds off, not just this caller
+            with self._cond:
+                self._paused_until = max(self._paused_until, now + delay)
+            telemetry.count(f"{self.name}.throttled")
+        telemetry.count(f"{self.name}.retries")
+        telemetry.event("retry", service=self.name, attempt=attempt + 1,
+                        delay=round(delay, 3), error=str(exc)[:200])
+        return delay
+
+    @contextmanager
+    def _slot(self):
+        with self._cond:
+            while self.in_flight >= max(1, int(self.limit)):
+                self._cond.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def _async_slot(self):
+        while True:
+            with self._cond:
+                if self.in_flight < max(1, int(self.limit)):
+                    self.in_flight += 1
+                    break
+                waiter = asyncio.get_running_loop().create_future()
+                self._async_waiters.append(waiter)
+            await waiter
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def call(self, fn, *args, tokens=0, **kwargs):
+        """Call `fn` within the limits, retrying transient failures"""
+        attempt = 0
+        while True:
+            telemetry.sleep(self._reserve(tokens), f"{self.name}_rate_limit")
+            with self._slot():
+                started = time.monotonic()
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, started)
+                    if delay is None:
+                        raise
+                else:
+                    self._succeeded()
+                    return result
+            telemetry.sleep(delay, f"{self.name}_retry")
+            attempt += 1
+
+    async def call_async(self, fn, *args, tokens=0, **kwargs):
+        """Await `fn(*args, **kwargs)` within the limits, retrying transient failures"""
+        attempt = 0
+        while True:
+            await self._sleep(self._reserve(tokens), "rate_limit")
+            async with self._async_slot():
+                started = time.monotonic()
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, started)
+                    if delay is None:
+                        raise
+                else:
+                    self._succeeded()
+                    return result
+            await self._sleep(delay, "retry")
+            attempt += 1
+
+    async def _sleep(self, seconds, reason):
+        if seconds > 0:
+            telemetry.backoff(seconds, f"{self.name}_{reason}")
+            await asyncio.sleep(seconds)
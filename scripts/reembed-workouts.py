@@ -1,75 +1,200 @@
+import argparse
+import atexit
+import hashlib
+import json
 import os
-import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from dotenv import load_dotenv
 from supabase import create_client, Client
 from openai import OpenAI
+import httpx
 import datetime
 
-# Load environment variables from .env.local
-dotenv_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env.local')
-load_dotenv(dotenv_path)
+from embedding_cache import DEFAULT_CACHE_PATH, EmbeddingCache
+from embedding_quant import int8_to_bytea, quantize_int8, to_half, truncate_dimensions
+from ingest_telemetry import run_log_path, telemetry
+from rate_limiter import RateController, estimate_tokens
+from reembed_checkpoint import DEFAULT_CHECKPOINT_PATH, ReembedCheckpoint
+from workout_index import content_hash
 
-# Supabase setup
-url: str = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
-# Try to use service role key, fallback to anon key if not available
-key: str = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
+# Clients and log files are set up by init_clients() and setup_logging() from
+# main(), so the module can be imported (e.g. by scripts/bench_ingest.py)
+# without connecting to anything.
+supabase: Client = None
+openai_client: OpenAI = None
+log_file = None
+error_log_file = None
 
-if not url or not key:
-    print("ERROR: Missing Supabase URL or key. Please check your .env.local file.")
-    print("Required variables: NEXT_PUBLIC_SUPABASE_URL and either SUPABASE_SERVICE_ROLE_KEY or NEXT_PUBLIC_SUPABASE_ANON_KEY")
-    exit(1)
+EMBEDDING_MODEL = "text-embedding-3-small"
+NATIVE_DIMENSIONS = 1536
 
-print(f"Using Supabase URL: {url}")
-print(f"Using key starting with: {key[:10]}...")
+@dataclass
+class EmbeddingStorage:
+    """What gets written to external_workouts_new for each workout.
 
-supabase: Client = create_client(url, key)
+    `dimensions` other than the model's native size is requested from the
+    API directly, and only fits the variant columns since `embedding` holds
+    native-size vectors. `variants` adds compact copies ("half" -> embedding_half,
+    "int8" -> embedding_int8 + embedding_int8_scale), optionally truncated
+    to `variant_dimensions`. With `include_full` off only the variants are
+    written.
+    """
+    dimensions: int = NATIVE_DIMENSIONS
+    variants: tuple = ()
+    variant_dimensions: int = None
+    include_full: bool = True
 
-# OpenAI setup
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    @property
+    def request_dimensions(self):
+        return None if self.dimensions == NATIVE_DIMENSIONS else self.dimensions
 
-# Create logs directory if it doesn't exist
-logs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../logs")
-os.makedirs(logs_dir, exist_ok=True)
+    @property
+    def model_version(self):
+        """Recorded per row in the checkpoint; rows written under another version are stale"""
+        version = f"{EMBEDDING_MODEL}:{self.dimensions}"
+        if not self.include_full:
+            version += "/compact-only"
+        for variant in self.variants:
+            version += f"+{variant}:{self.variant_dimensions or self.dimensions}"
+        return version
 
-# Setup logging
-timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-log_file = os.path.join(logs_dir, f"reembed_{timestamp}.log")
-error_log_file = os.path.join(logs_dir, f"reembed_errors_{timestamp}.log")
+storage = EmbeddingStorage()
+
+# Retries, backoff and adaptive concurrency for each remote service
+embedding_limits = RateController("embed")
+database_limits = RateController("db")
+
+def init_clients():
+    """Create the Supabase and OpenAI clients from .env.local"""
+    global supabase, openai_client
+    
+    # Load environment variables from .env.local
+    dotenv_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env.local')
+    load_dotenv(dotenv_path)
+    
+    # Supabase setup
+    url: str = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
+    # Try to use service role key, fallback to anon key if not available
+    key: str = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
+    
+    if not url or not key:
+        print("ERROR: Missing Supabase URL or key. Please check your .env.local file.")
+        print("Required variables: NEXT_PUBLIC_SUPABASE_URL and either SUPABASE_SERVICE_ROLE_KEY or NEXT_PUBLIC_SUPABASE_ANON_KEY")
+        exit(1)
+    
+    print(f"Using Supabase URL: {url}")
+    print(f"Using key starting with: {key[:10]}...")
+    
+    supabase = create_client(url, key)
+    
+    # OpenAI setup; retries are left to embedding_limits, and the hooks
+    # count every HTTP attempt
+    openai_client = OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=0,
+        http_client=httpx.Client(event_hooks=telemetry.httpx_hooks())
+    )
+
+def setup_logging():
+    """Open timestamped log files and the telemetry log in the logs directory.
+
+    The text logs stay open for the whole run. Errors are written through
+    line by line; the main log is flushed along with the telemetry buffer.
+    """
+    global log_file, error_log_file
+    
+    # Create logs directory if it doesn't exist
+    logs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../logs")
+    os.makedirs(logs_dir, exist_ok=True)
+    
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    log_file = open(os.path.join(logs_dir, f"reembed_{timestamp}.log"), "a")
+    error_log_file = open(os.path.join(logs_dir, f"reembed_errors_{timestamp}.log"), "a", buffering=1)
+    atexit.register(log_file.close)
+    atexit.register(error_log_file.close)
+    
+    telemetry.open(run_log_path("reembed_telemetry"))
+    telemetry.on_flush(flush_logs)
+
+def flush_logs():
+    if log_file and not log_file.closed:
+        log_file.flush()
 
 def log_message(message):
     """Log message to both console and file"""
     print(message)
-    with open(log_file, "a") as f:
-        f.write(f"{datetime.datetime.now().isoformat()}: {message}\n")
+    telemetry.log("info", message)
+    if log_file:
+        log_file.write(f"{datetime.datetime.now().isoformat()}: {message}\n")
 
 def log_error(message):
     """Log error to both console and error file"""
     print(f"ERROR: {message}")
-    with open(error_log_file, "a") as f:
-        f.write(f"{datetime.datetime.now().isoformat()}: {message}\n")
+    telemetry.log("error", message)
+    telemetry.count("errors_logged")
+    if error_log_file:
+        error_log_file.write(f"{datetime.datetime.now().isoformat()}: {message}\n")
 
-def get_embedding(text):
-    """Generate a single embedding using text-embedding-3-small"""
-    try:
-        response = openai_client.embeddings.create(
-            input=text,
-            model="text-embedding-3-small"
+def fit_dimensions(embedding, dimensions=None):
+    """Pad or trim an embedding to exactly `dimensions` values"""
+    dimensions = dimensions or storage.dimensions
+    if len(embedding) > dimensions:
+        return embedding[:dimensions]
+    if len(embedding) < dimensions:
+        return embedding + [0.0] * (dimensions - len(embedding))
+    return embedding
+
+def create_embeddings(texts):
+    """One embeddings API attempt, feeding the rate-limit headers to embedding_limits"""
+    options = {}
+    if storage.request_dimensions:
+        options["dimensions"] = storage.request_dimensions
+    with telemetry.timed("embed", inputs=len(texts), request_chars=sum(len(t) for t in texts)) as stats:
+        raw = openai_client.embeddings.with_raw_response.create(
+            input=texts,
+            model=EMBEDDING_MODEL,
+            **options
         )
-        embedding = response.data[0].embedding
-        
-        # Ensure the embedding is exactly 1536 dimensions
-        if len(embedding) > 1536:
-            log_message(f"Trimming embedding from {len(embedding)} to 1536 dimensions")
-            embedding = embedding[:1536]  # Take only the first 1536 dimensions
-        elif len(embedding) < 1536:
-            log_message(f"Padding embedding from {len(embedding)} to 1536 dimensions")
-            embedding = embedding + [0.0] * (1536 - len(embedding))  # Pad with zeros
-            
-        return embedding
+        embedding_limits.observe(raw.headers)
+        response = raw.parse()
+        stats["tokens"] = response.usage.total_tokens if response.usage else 0
+        stats["response_bytes"] = sum(len(item.embedding) for item in response.data) * 4
+    return response
+
+def request_embeddings(texts):
+    """Call the embeddings API for a list of texts, in input order"""
+    response = embedding_limits.call(create_embeddings, texts, tokens=estimate_tokens(texts))
+    embeddings = [None] * len(texts)
+    for item in response.data:
+        embeddings[item.index] = item.embedding
+
+    if any(embedding is None for embedding in embeddings):
+        raise ValueError(f"Expected {len(texts)} embeddings, got {len(response.data)}")
+
+    return embeddings
+
+def get_embeddings(texts, cache=None):
+    """Generate embeddings for a list of texts in a single API call.
+
+    Results are mapped back to their inputs by the `index` field of each
+    returned item, so the output list lines up with `texts`. When a cache is
+    given, only texts it doesn't already hold are sent to the API.
+    """
+    try:
+        if cache is not None:
+            embeddings = cache.embed(texts, EMBEDDING_MODEL, storage.request_dimensions, request_embeddings)
+        else:
+            embeddings = request_embeddings(texts)
+        return [fit_dimensions(embedding) for embedding in embeddings]
     except Exception as e:
-        log_error(f"Error generating embedding: {str(e)}")
+        log_error(f"Error generating embeddings for batch of {len(texts)}: {str(e)}")
         raise
 
+def get_embedding(text):
+    """Generate a single embedding using text-embedding-3-small"""
+    return get_embeddings([text])[0]
+
 def create_tables_and_functions():
     """Create the necessary tables and functions in Supabase"""
     log_message("Setting up tables and functions in Supabase...")
@@ -88,6 +213,29 @@ def create_tables_and_functions():
         log_error(f"Error setting up database: {str(e)}")
         return False
 
+def check_variant_columns():
+    """Make sure external_workouts_new has a column for every compact variant.
+
+    The columns come from a migration that only alters the table if it
+    already exists, so a database where create_workouts_with_single_embedding()
+    ran afterwards won't have them.
+    """
+    columns = []
+    if "half" in storage.variants:
+        columns.append("embedding_half")
+    if "int8" in storage.variants:
+        columns += ["embedding_int8", "embedding_int8_scale"]
+    if not columns:
+        return True
+    
+    try:
+        supabase.table("external_workouts_new").select(",".join(columns)).limit(1).execute()
+        return True
+    except Exception as e:
+        log_error(f"external_workouts_new is missing columns for --variants ({', '.join(columns)}); "
+                  f"apply the compact embeddings migration first: {str(e)}")
+        return False
+
 def count_workouts():
     """Count total workouts to process"""
     try:
@@ -97,106 +245,325 @@ def count_workouts():
         log_error(f"Error counting workouts: {str(e)}")
         return 0
 
-def reembed_workouts(batch_size=10, start_id=0, rate_limit_delay=0.5):
-    """Process workouts in batches and re-embed them"""
+def chunked(items, size):
+    """Yield successive slices of `items` of at most `size` elements"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def row_hash(workout):
+    """Fingerprint of everything that feeds a workout's new table row"""
+    tags = json.dumps(workout.get("tags") or [], sort_keys=True)
+    payload = f"{content_hash(workout['title'], workout['body'])}\n{tags}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def build_row(workout, embedding):
+    row = {
+        "id": workout["id"],
+        "title": workout["title"],
+        "body": workout["body"],
+        "tags": workout.get("tags", []),
+        "difficulty": workout.get("difficulty", "Intermediate"),
+    }
+    if storage.include_full:
+        row["embedding"] = embedding
+    
+    compact = embedding
+    if storage.variant_dimensions and storage.variant_dimensions < len(embedding):
+        compact = truncate_dimensions(embedding, storage.variant_dimensions)
+    if "half" in storage.variants:
+        row["embedding_half"] = to_half(compact)
+    if "int8" in storage.variants:
+        codes, scale = quantize_int8(compact)
+        row["embedding_int8"] = int8_to_bytea(codes)
+        row["embedding_int8_scale"] = scale
+    return row
+
+def upsert_rows(rows):
+    with telemetry.timed("db_write", rows=len(rows)):
+        supabase.table("external_workouts_new").upsert(rows).execute()
+    telemetry.count("rows_written", len(rows))
+
+def embed_and_store(batch, cache=None):
+    """Embed and upsert a batch, isolating rows that fail.
+
+    The whole batch is tried first, with transient errors retried by the
+    rate controllers. If the embeddings call or the upsert still fails, each
+    row is retried on its own so one bad row can't sink the rest.
+    Returns the stored workouts and a dict of failed workout ID to error.
+    """
+    if not batch:
+        return [], {}
+    # Combine title and body for better embedding context
+    texts = [f"{workout['title']} {workout['body']}" for workout in batch]
+    try:
+        embeddings = get_embeddings(texts, cache)
+        rows = [build_row(w, e) for w, e in zip(batch, embeddings)]
+        database_limits.call(upsert_rows, rows)
+        return batch, {}
+    except Exception as e:
+        if len(batch) == 1:
+            return [], {batch[0]["id"]: str(e)}
+        log_error(f"Batch {batch[0]['id']}-{batch[-1]['id']} failed, retrying rows individually: {str(e)}")
+
+    stored = []
+    failed = {}
+    for workout in batch:
+        rows, errors = embed_and_store([workout], cache)
+        stored.extend(rows)
+        failed.update(errors)
+    return stored, failed
+
+def select_page(after_id, page_size):
+    with telemetry.timed("db_read") as stats:
+        response = supabase.table("external_workouts") \
+                          .select("id,title,body,tags,difficulty") \
+                          .gt("id", after_id) \
+                          .order("id") \
+                          .limit(page_size) \
+                          .execute()
+        stats["rows"] = len(response.data or [])
+    return response.data or []
+
+def fetch_page(after_id, page_size):
+    """Fetch the next page of workouts, retrying transient errors with backoff"""
+    return database_limits.call(select_page, after_id, page_size)
+
+def reembed_workouts(page_size=100, batch_size=50, start_id=None, rate_limit_delay=0.0, cache=None,
+                     checkpoint=None, incremental=False, concurrency=4):
+    """Process workouts page by page and re-embed them in batches.
+
+    Up to `concurrency` batches of `batch_size` rows are in flight at once,
+    and results are committed in ID order.
+    """
+    mode = "incremental" if incremental else "full"
     total = count_workouts()
-    log_message(f"Found {total} workouts to re-embed")
+    log_message(f"Found {total} workouts to {'check' if incremental else 're-embed'}")
     
     processed = 0
+    skipped = 0
     errors = 0
-    current_id = start_id
+    if start_id is not None:
+        current_id = start_id
+    elif checkpoint is not None:
+        current_id = checkpoint.last_id(mode)
+        if current_id:
+            log_message(f"Resuming {mode} run after workout {current_id}")
+    else:
+        current_id = 0
     
     # Don't log every embedding dimension except for the first one
     log_dimensions = True
     
-    while True:
-        try:
-            # Fetch a batch of workouts
-            response = supabase.table("external_workouts") \
-                              .select("id,title,body,tags,difficulty") \
-                              .gt("id", current_id) \
-                              .order("id") \
-                              .limit(batch_size) \
-                              .execute()
-            
-            workouts = response.data
+    # Batches are embedded and stored on worker threads; the checkpoint and
+    # progress logging stay on this thread and see results in ID order
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            try:
+                workouts = fetch_page(current_id, page_size)
+            except Exception as e:
+                log_error(f"Giving up after repeated failures fetching workouts after ID {current_id}: {str(e)}")
+                errors += 1
+                break
             
-            if not workouts or len(workouts) == 0:
+            if not workouts:
                 log_message("No more workouts to process")
+                # Only interrupted runs keep their cursor
+                if checkpoint is not None:
+                    checkpoint.reset(mode)
                 break
             
-            log_message(f"Processing batch of {len(workouts)} workouts starting at ID {current_id}")
+            log_message(f"Processing page of {len(workouts)} workouts starting at ID {current_id}")
+            
+            pending = []
+            for batch in chunked(workouts, batch_size):
+                hashes = {workout["id"]: row_hash(workout) for workout in batch}
+                todo = batch
+                if checkpoint is not None:
+                    dead = checkpoint.dead_ids(hashes)
+                    todo = [workout for workout in todo if workout["id"] not in dead]
+                    if incremental:
+                        stale = {row_id for row_id, _ in checkpoint.stale(list(hashes.items()), storage.model_version)}
+                        todo = [workout for workout in todo if workout["id"] in stale]
+                skipped += len(batch) - len(todo)
+                telemetry.count("rows_skipped", len(batch) - len(todo))
+                pending.append((batch, hashes, pool.submit(embed_and_store, todo, cache) if todo else None))
             
-            for workout in workouts:
-                try:
-                    # Combine title and body for better embedding context
-                    text_to_embed = f"{workout['title']} {workout['body']}"
-                    
-                    # Generate new embedding
-                    try:
-                        embedding = get_embedding(text_to_embed)
-                        
-                        # Only log dimensions for the first workout
-                        if log_dimensions:
-                            log_message(f"First embedding dimensions: {len(embedding)}")
-                            log_dimensions = False
-                            
-                    except Exception as e:
-                        log_error(f"Error generating embedding for workout {workout['id']}: {str(e)}")
-                        errors += 1
-                        current_id = workout["id"]
-                        continue
-                    
-                    # Insert into new table
-                    insert_data = {
-                        "id": workout["id"],
-                        "title": workout["title"],
-                        "body": workout["body"],
-                        "tags": workout.get("tags", []),
-                        "difficulty": workout.get("difficulty", "Intermediate"),
-                        "embedding": embedding
-                    }
-                    
-                    try:
-                        supabase.table("external_workouts_new").insert(insert_data).execute()
-                        
-                        processed += 1
-                        # Log progress every 10 workouts or for the first and last
-                        if processed % 10 == 0 or processed == 1 or processed == total:
-                            log_message(f"Re-embedded workout {workout['id']} - {processed}/{total} ({processed/total*100:.1f}%)")
-                        
-                    except Exception as e:
-                        log_error(f"Error inserting workout {workout['id']}: {str(e)}")
-                        errors += 1
-                    
-                    # Update current_id for next batch
-                    current_id = workout["id"]
-                    
-                except Exception as e:
-                    errors += 1
-                    log_error(f"Error processing workout {workout['id']}: {str(e)}")
-                    current_id = workout["id"]
+            for batch, hashes, future in pending:
+                if future is None:
+                    if checkpoint is not None:
+                        checkpoint.advance(mode, batch[-1]["id"])
+                    continue
                 
-                # Sleep to avoid rate limits
-                time.sleep(rate_limit_delay)
+                stored, failed = future.result()
+                telemetry.count("rows_failed", len(failed))
                 
-        except Exception as e:
-            log_error(f"Error processing batch: {str(e)}")
-            errors += 1
-            time.sleep(2)  # Longer delay after an error
+                # Only log dimensions for the first batch
+                if log_dimensions and stored:
+                    log_message(f"Embedding dimensions: {storage.dimensions} ({storage.model_version})")
+                    log_dimensions = False
+                
+                for row_id, error in failed.items():
+                    log_error(f"Error re-embedding workout {row_id}: {error}")
+                    if checkpoint is not None:
+                        checkpoint.dead_letter(row_id, error)
+                errors += len(failed)
+                
+                if checkpoint is not None:
+                    checkpoint.commit(
+                        mode,
+                        batch[-1]["id"],
+                        [(workout["id"], hashes[workout["id"]]) for workout in stored],
+                        storage.model_version
+                    )
+                
+                previous = processed
+                processed += len(stored)
+                # Log progress roughly every 100 workouts, and for the first and last batch
+                if stored and (previous == 0 or processed // 100 != previous // 100 or processed >= total):
+                    log_message(f"Re-embedded up to workout {batch[-1]['id']} - {processed}/{total} ({processed/max(total, 1)*100:.1f}%)")
+            
+            # Move past this page
+            current_id = workouts[-1]["id"]
+            telemetry.sleep(rate_limit_delay, "rate_limit_delay")
     
+    if skipped:
+        log_message(f"Skipped {skipped} unchanged or dead-lettered workouts")
     return processed, errors
 
+def retry_dead_letters(checkpoint, batch_size=50, cache=None):
+    """Re-attempt every dead-lettered workout once"""
+    ids = [row_id for row_id, _, _ in checkpoint.dead_letters()]
+    log_message(f"Retrying {len(ids)} dead-lettered workouts")
+    
+    processed = 0
+    errors = 0
+    for id_batch in chunked(ids, batch_size):
+        response = database_limits.call(
+            supabase.table("external_workouts")
+                    .select("id,title,body,tags,difficulty")
+                    .in_("id", id_batch)
+                    .execute
+        )
+        batch = response.data or []
+        # Rows deleted upstream since they failed are dropped from the list
+        checkpoint.drop_dead_letters(set(id_batch) - {workout["id"] for workout in batch})
+        if not batch:
+            continue
+        stored, failed = embed_and_store(batch, cache)
+        for row_id, error in failed.items():
+            log_error(f"Error re-embedding workout {row_id}: {error}")
+            checkpoint.dead_letter(row_id, error)
+        checkpoint.record([(workout["id"], row_hash(workout)) for workout in stored], storage.model_version)
+        processed += len(stored)
+        errors += len(failed)
+    return processed, errors
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Re-embed external workouts into external_workouts_new")
+    parser.add_argument("--page-size", type=int, default=100,
+                        help="Rows fetched from external_workouts per request")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Texts embedded per API call and rows written per upsert")
+    parser.add_argument("--start-id", type=int, default=None,
+                        help="Only re-embed workouts with an ID greater than this (overrides the checkpoint)")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="Extra seconds to pause between pages; normally the rate controller paces requests")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Most batches embedded and stored at once; lowered automatically when throttled")
+    parser.add_argument("--requests-per-minute", type=int, default=None,
+                        help="Cap on embeddings requests per minute (otherwise learned from response headers)")
+    parser.add_argument("--tokens-per-minute", type=int, default=None,
+                        help="Cap on embedding tokens per minute (otherwise learned from response headers)")
+    parser.add_argument("--cache-path", default=DEFAULT_CACHE_PATH,
+                        help="SQLite file holding previously computed embeddings")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always call the embeddings API")
+    parser.add_argument("--checkpoint-path", default=DEFAULT_CHECKPOINT_PATH,
+                        help="SQLite file recording progress between runs")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the saved cursor and start from the first workout")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-embed workouts that changed or were embedded with an older model")
+    parser.add_argument("--retry-dead-letters", action="store_true",
+                        help="Retry previously failed workouts instead of scanning the table")
+    parser.add_argument("--dimensions", type=int, default=NATIVE_DIMENSIONS,
+                        help="Request reduced-dimension embeddings from the API (requires --no-full)")
+    parser.add_argument("--variants", default="",
+                        help="Comma-separated compact copies to store: half, int8")
+    parser.add_argument("--variant-dimensions", type=int, default=None,
+                        help="Truncate compact copies to this many dimensions")
+    parser.add_argument("--no-full", action="store_true",
+                        help="Store only the compact copies, not the full embedding column")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    setup_logging()
+    variants = tuple(v.strip() for v in args.variants.split(",") if v.strip())
+    unknown = set(variants) - {"half", "int8"}
+    if unknown:
+        log_error(f"Unknown variants: {', '.join(sorted(unknown))}")
+        return
+    if args.no_full and not variants:
+        log_error("--no-full needs at least one of --variants half,int8")
+        return
+    if args.dimensions != NATIVE_DIMENSIONS and not args.no_full:
+        log_error(f"The embedding column holds {NATIVE_DIMENSIONS}-dimension vectors; "
+                  f"--dimensions {args.dimensions} needs --no-full and --variants")
+        return
+    storage.dimensions = args.dimensions
+    storage.variants = variants
+    storage.variant_dimensions = args.variant_dimensions
+    storage.include_full = not args.no_full
+    embedding_limits.configure(
+        concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute
+    )
+    database_limits.configure(concurrency=args.concurrency)
+    
+    init_clients()
+    
     log_message("Starting workout re-embedding process")
     
     # Create necessary tables and functions
     if not create_tables_and_functions():
         log_error("Failed to set up database. Exiting.")
         return
+    if not check_variant_columns():
+        return
     
     # Re-embed workouts
-    processed, errors = reembed_workouts(batch_size=10)
+    cache = None if args.no_cache else EmbeddingCache(args.cache_path)
+    checkpoint = ReembedCheckpoint(args.checkpoint_path)
+    
+    if args.retry_dead_letters:
+        processed, errors = retry_dead_letters(checkpoint, batch_size=args.batch_size, cache=cache)
+    else:
+        if args.restart:
+            checkpoint.reset("incremental" if args.incremental else "full")
+        processed, errors = reembed_workouts(
+            page_size=args.page_size,
+            batch_size=args.batch_size,
+            start_id=args.start_id,
+            rate_limit_delay=args.delay,
+            cache=cache,
+            checkpoint=checkpoint,
+            incremental=args.incremental,
+            concurrency=args.concurrency
+        )
+    
+    dead = checkpoint.dead_letters()
+    if dead:
+        log_message(f"{len(dead)} workouts are dead-lettered; rerun with --retry-dead-letters to retry them")
+    checkpoint.close()
+    
+    if cache is not None:
+        stats = cache.stats()
+        log_message(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']*100:.1f}% hit rate)")
+        telemetry.count("cache_hits", stats["hits"])
+        telemetry.count("cache_misses", stats["misses"])
+        cache.close()
     
     log_message(f"Re-embedding process complete.")
     log_message(f"Processed: {processed} workouts")
@@ -207,6 +574,8 @@ def main():
         log_message("You can now use the new search endpoint at /api/search-workouts-new")
     else:
         log_message(f"Process completed with {errors} errors. Check the error log for details.")
+    
+    print(telemetry.finish())
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""Persistent progress for scripts/reembed-workouts.py.
+
+A small SQLite file records, per run mode, the last workout ID whose batch
+was committed, plus the content hash and embedding model of every row
+written so far. Restarts resume from the cursor and incremental runs use the
+per-row records to skip workouts that haven't changed. Rows that keep
+failing are parked in a dead-letter table instead of blocking the run.
+"""
+import os
+import sqlite3
+import time
+
+DEFAULT_CHECKPOINT_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ".cache",
+    "reembed_checkpoint.sqlite3"
+)
+
+
+class ReembedCheckpoint:
+    """Cursor, per-row fingerprints and dead letters for re-embedding runs"""
+
+    def __init__(self, path=DEFAULT_CHECKPOINT_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS cursors (
+                mode TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS rows (
+                id INTEGER PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY,
+                error TEXT,
+                attempts INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            """
+        )
+        self._conn.commit()
+
+    def last_id(self, mode):
+        row = self._conn.execute("SELECT last_id FROM cursors WHERE mode = ?", (mode,)).fetchone()
+        return row[0] if row else 0
+
+    def reset(self, mode):
+        """Forget the cursor, so the next run of `mode` starts from the first workout.
+
+        Called after a run scans the whole table, so only interrupted runs
+        resume, and for --restart.
+        """
+        self._conn.execute("DELETE FROM cursors WHERE mode = ?", (mode,))
+        self._conn.commit()
+
+    def advance(self, mode, last_id):
+        """Move the cursor without recording any rows"""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO cursors (mode, last_id, updated_at) VALUES (?, ?, ?)",
+            (mode, last_id, time.time())
+        )
+        self._conn.commit()
+
+    def commit(self, mode, last_id, rows, model):
+        """Record written rows and advance the cursor in one transaction.
+
+        `rows` is a list of (id, content_hash) pairs.
+        """
+        with self._conn:
+            self._record(rows, model)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cursors (mode, last_id, updated_at) VALUES (?, ?, ?)",
+                (mode, last_id, time.time())
+            )
+
+    def record(self, rows, model):
+        """Record written rows without touching any cursor"""
+        with self._conn:
+            self._record(rows, model)
+
+    def _record(self, rows, model):
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO rows (id, content_hash, model, updated_at) VALUES (?, ?, ?, ?)",
+            [(row_id, digest, model, now) for row_id, digest in rows]
+        )
+        self._drop_dead_letters(row_id for row_id, _ in rows)
+
+    def stale(self, rows, model):
+        """Return the subset of (id, content_hash) pairs that need re-embedding"""
+        ids = [row_id for row_id, _ in rows]
+        known = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            known.update(
+                (row_id, (digest, row_model))
+                for row_id, digest, row_model in self._conn.execute(
+                    f"SELECT id, content_hash, model FROM rows WHERE id IN ({placeholders})", chunk
+                )
+            )
+        return [(row_id, digest) for row_id, digest in rows if known.get(row_id) != (digest, model)]
+
+    def dead_letter(self, row_id, error):
+        self._conn.execute(
+            """INSERT INTO dead_letters (id, error, attempts, updated_at) VALUES (?, ?, 1, ?)
+               ON CONFLICT(id) DO UPDATE SET error = excluded.error,
+                   attempts = attempts + 1, updated_at = excluded.updated_at""",
+            (row_id, error, time.time())
+        )
+        self._conn.commit()
+
+    def drop_dead_letters(self, ids):
+        with self._conn:
+            self._drop_dead_letters(ids)
+
+    def _drop_dead_letters(self, ids):
+        self._conn.executemany("DELETE FROM dead_letters WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def dead_letters(self):
+        """All parked rows as (id, error, attempts), oldest ID first"""
+        return self._conn.execute(
+            "SELECT id, error, attempts FROM dead_letters ORDER BY id"
+        ).fetchall()
+
+    def dead_ids(self, ids):
+        ids = list(ids)
+        dead = set()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            dead.update(
+                row[0] for row in self._conn.execute(
+                    f"SELECT id FROM dead_letters WHERE id IN ({placeholders})", chunk
+                )
+            )
+        return dead
+
+    def close(self):
+        self._conn.close()
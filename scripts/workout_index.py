@@ -0,0 +1,89 @@
+"""In-memory index of workouts already stored in Supabase.
+
+The scraper loads the index once at start-up and checks every parsed
+workout against it locally, so deduplication costs a set lookup instead of
+a SELECT per workout, and known workouts never reach the embeddings API.
+"""
+import hashlib
+import re
+import unicodedata
+
+# The whitespace the content_hash migration collapses in SQL. str.split()
+# would also collapse U+00A0 (&nbsp;) and other Unicode spaces, which
+# Postgres leaves alone, so the two hashes would disagree.
+_WHITESPACE = re.compile(r"[ \t\n\r\f\v]+")
+
+
+def _normalize(text):
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text or "")).strip(" ")
+
+
+def content_hash(title, body):
+    """Stable hash of a workout's content.
+
+    Kept in sync with the backfill in the external_workouts content_hash
+    migration, which applies the same normalization in SQL.
+    """
+    payload = f"{_normalize(title)}\n{_normalize(body)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class KnownWorkouts:
+    """Titles and content hashes of stored workouts.
+
+    `titles` maps each stored title to its row ID, and titles claimed during
+    this run to None. A normal crawl uses `claim`, which drops anything
+    already stored. Replaying cached pages uses `claim_replacement` instead,
+    so a workout whose extracted content changed updates the row with the
+    same title rather than being skipped.
+    """
+
+    def __init__(self):
+        self.titles = {}
+        self.hashes = set()
+
+    @classmethod
+    def load(cls, supabase, table="external_workouts", page_size=1000):
+        """Stream the title/hash set out of `table` in keyset-paginated pages"""
+        index = cls()
+        last_id = 0
+        while True:
+            response = supabase.table(table) \
+                               .select("id,title,content_hash") \
+                               .gt("id", last_id) \
+                               .order("id") \
+                               .limit(page_size) \
+                               .execute()
+            rows = response.data or []
+            for row in rows:
+                if row.get("title"):
+                    index.titles[row["title"]] = row["id"]
+                if row.get("content_hash"):
+                    index.hashes.add(row["content_hash"])
+            if len(rows) < page_size:
+                return index
+            last_id = rows[-1]["id"]
+
+    def claim(self, title, digest):
+        """Record a workout, returning False if it is already known"""
+        if digest in self.hashes or title in self.titles:
+            return False
+        self.hashes.add(digest)
+        self.titles[title] = None
+        return True
+
+    def claim_replacement(self, title, digest):
+        """Record a re-extracted workout, allowing changed content under a stored title.
+
+        Returns (store, row_id). `store` is False if this content is already
+        stored or the title was already claimed in this run; otherwise
+        `row_id` is the ID of the stored row to update, or None for a new one.
+        """
+        if digest in self.hashes:
+            return False, None
+        if title in self.titles and self.titles[title] is None:
+            return False, None
+        self.hashes.add(digest)
+        row_id = self.titles.get(title)
+        self.titles[title] = None
+        return True, row_id
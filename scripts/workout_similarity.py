@@ -0,0 +1,464 @@
+"""Offline similarity search over a local snapshot of workout embeddings.
+
+Batch jobs such as near-duplicate detection or precomputing "similar
+workouts" lists used to cost one match_* RPC per query. This tool exports
+every embedding from external_workouts_new (or the split-vector
+external_workouts) once into a memory-mapped float32 matrix with an ID
+sidecar, then answers top-k and all-pairs queries locally with blocked
+matrix multiplies. An optional IVF index (spherical k-means over the
+snapshot) narrows each lookup to the closest clusters, and the recall
+command measures how much result quality reduced-dimension, float16 and
+int8 storage would give up relative to the full vectors.
+
+Usage:
+    python scripts/workout_similarity.py export snapshots/workouts
+    python scripts/workout_similarity.py query snapshots/workouts --id 42 --k 10
+    python scripts/workout_similarity.py dupes snapshots/workouts --threshold 0.97
+    python scripts/workout_similarity.py neighbors snapshots/workouts --k 20 --out similar.jsonl
+    python scripts/workout_similarity.py build-ivf snapshots/workouts --nlist 256
+    python scripts/workout_similarity.py recall snapshots/workouts --dimensions full,512 --forms float32,int8
+
+Requires numpy.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Rows per block in blocked matrix multiplies; 8192 x 1536 float32 is ~48 MB
+DEFAULT_BLOCK_SIZE = 8192
+
+# Columns holding each table's embedding. external_workouts splits every
+# vector in two and match_similar_workouts averages the two cosine scores.
+TABLE_COLUMNS = {
+    "external_workouts_new": ["embedding"],
+    "external_workouts": ["embedding_part1", "embedding_part2"],
+}
+
+
+def _parse_vector(value):
+    """pgvector columns come back from PostgREST as '[0.1,0.2,...]' strings"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _combine_parts(parts):
+    """Join embedding parts so a dot product equals the mean of per-part cosines"""
+    if len(parts) == 1:
+        return _normalize(parts[0])
+    return np.concatenate([_normalize(part) for part in parts]) / np.sqrt(len(parts))
+
+
+def blocked_top_k(vectors, queries, k=10, block_size=DEFAULT_BLOCK_SIZE, exclude=None):
+    """Exact top-k over the rows of `vectors`, one block of rows at a time"""
+    queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+    m = queries.shape[0]
+    n = len(vectors)
+    k = min(k, n)
+    best_scores = np.full((m, k), -np.inf, dtype=np.float32)
+    best_rows = np.full((m, k), -1, dtype=np.int64)
+    if k == 0:
+        return best_scores, best_rows
+
+    for start in range(0, n, block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        scores = queries @ block.T
+        if exclude is not None:
+            local = np.asarray(exclude) - start
+            hit = (local >= 0) & (local < block.shape[0])
+            scores[np.nonzero(hit)[0], local[hit]] = -np.inf
+
+        rows = np.broadcast_to(np.arange(start, start + block.shape[0]), scores.shape)
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_rows = np.concatenate([best_rows, rows], axis=1)
+        keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(merged_scores, keep, axis=1)
+        best_rows = np.take_along_axis(merged_rows, keep, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+
+def compact_form(vectors, dimensions=None, form="float32"):
+    """Encode rows the way reembed-workouts.py stores compact variants.
+
+    Mirrors embedding_quant: truncate to `dimensions` and re-normalize, then
+    round to float16 or quantize to per-row-scaled int8. Returns the decoded
+    float32 matrix, re-normalized so scores stay cosines, and the stored
+    bytes per vector.
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if dimensions and dimensions < matrix.shape[1]:
+        matrix = _normalize(matrix[:, :dimensions])
+    dim = matrix.shape[1]
+
+    if form == "float16":
+        return _normalize(matrix.astype(np.float16).astype(np.float32)), dim * 2
+    if form == "int8":
+        scale = np.abs(matrix).max(axis=1, keepdims=True) / 127
+        scale[scale == 0] = 1.0
+        codes = np.clip(np.rint(matrix / scale), -127, 127).astype(np.int8)
+        return _normalize(codes.astype(np.float32) * scale), dim + 4
+    return matrix, dim * 4
+
+
+def _payload_chars(matrix, form):
+    """Approximate PostgREST text size of one vector in this form"""
+    sample = matrix[:32]
+    if form == "int8":
+        # bytea hex literal plus the scale column
+        return 2 * matrix.shape[1] + 2 + 12
+    digits = 4 if form == "float16" else 7
+    return int(np.mean([
+        len("[" + ",".join(f"{x:.{digits}g}" for x in row) + "]") for row in sample
+    ]))
+
+
+def recall_benchmark(snapshot, k=10, queries=500, dimensions=(None,), forms=("float32", "float16", "int8"),
+                     block_size=DEFAULT_BLOCK_SIZE, seed=0):
+    """Recall@k of each compact form against the full-precision snapshot.
+
+    A random sample of rows is used as queries, each excluded from its own
+    results. Yields one dict per (dimensions, form) combination.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(snapshot)
+    query_rows = np.sort(rng.choice(n, size=min(queries, n), replace=False))
+    _, truth = blocked_top_k(snapshot.vectors, snapshot.vectors[query_rows], k, block_size, exclude=query_rows)
+    full_dim = snapshot.meta["dim"]
+
+    for dims in dimensions:
+        for form in forms:
+            matrix, vector_bytes = compact_form(snapshot.vectors, dims, form)
+            started = time.perf_counter()
+            _, found = blocked_top_k(matrix, matrix[query_rows], k, block_size, exclude=query_rows)
+            elapsed = time.perf_counter() - started
+            hits = [len(set(a) & set(b)) for a, b in zip(truth, found)]
+            yield {
+                "dimensions": dims or full_dim,
+                "form": form,
+                "recall": float(np.mean(hits)) / k,
+                "bytes_per_vector": vector_bytes,
+                "table_mb": vector_bytes * n / 1024 ** 2,
+                "payload_chars": _payload_chars(matrix, form),
+                "ms_per_query": elapsed * 1000 / len(query_rows),
+            }
+
+
+def connect_supabase():
+    from dotenv import load_dotenv
+    from supabase import create_client
+
+    load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env.local"))
+    url = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
+    if not url or not key:
+        sys.exit("ERROR: Missing Supabase URL or key. Please check your .env.local file.")
+    return create_client(url, key)
+
+
+def export_snapshot(supabase, prefix, table="external_workouts_new", page_size=500):
+    """Stream every embedding in `table` to `prefix`.f32 / .ids.npy / .json.
+
+    Rows are appended to the matrix file as they arrive, so memory use stays
+    at one page regardless of table size. Vectors are stored unit-normalized
+    and rows with a missing embedding are skipped.
+    """
+    columns = TABLE_COLUMNS[table]
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+
+    ids = []
+    dim = None
+    last_id = 0
+    with open(f"{prefix}.f32", "wb") as matrix_file:
+        while True:
+            response = supabase.table(table) \
+                               .select(",".join(["id"] + columns)) \
+                               .gt("id", last_id) \
+                               .order("id") \
+                               .limit(page_size) \
+                               .execute()
+            rows = response.data or []
+            if not rows:
+                break
+
+            vectors = []
+            for row in rows:
+                if any(row.get(column) is None for column in columns):
+                    continue
+                vector = _combine_parts([_parse_vector(row[column]) for column in columns])
+                if dim is None:
+                    dim = vector.shape[0]
+                elif vector.shape[0] != dim:
+                    print(f"Skipping workout {row['id']}: {vector.shape[0]} dimensions, expected {dim}")
+                    continue
+                vectors.append(vector)
+                ids.append(row["id"])
+
+            if vectors:
+                np.stack(vectors).astype(np.float32).tofile(matrix_file)
+            print(f"Exported {len(ids)} embeddings (through ID {rows[-1]['id']})")
+            last_id = rows[-1]["id"]
+
+    np.save(f"{prefix}.ids.npy", np.asarray(ids, dtype=np.int64))
+    with open(f"{prefix}.json", "w") as f:
+        json.dump({"table": table, "columns": columns, "count": len(ids), "dim": dim or 0}, f)
+    return len(ids)
+
+
+class EmbeddingSnapshot:
+    """Read-only, memory-mapped matrix of unit-normalized embeddings"""
+
+    def __init__(self, prefix):
+        with open(f"{prefix}.json") as f:
+            self.meta = json.load(f)
+        self.prefix = prefix
+        self.ids = np.load(f"{prefix}.ids.npy")
+        self.vectors = np.memmap(
+            f"{prefix}.f32", dtype=np.float32, mode="r",
+            shape=(self.meta["count"], self.meta["dim"])
+        )
+        self._positions = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, workout_id):
+        """Row index of a workout ID"""
+        if self._positions is None:
+            self._positions = {int(workout_id): i for i, workout_id in enumerate(self.ids)}
+        return self._positions[int(workout_id)]
+
+    def top_k(self, queries, k=10, block_size=DEFAULT_BLOCK_SIZE, exclude=None):
+        """Exact top-k rows by cosine similarity for each query.
+
+        `queries` is an (m, dim) array. `exclude` optionally gives, per query,
+        a row index to leave out (used to drop a row from its own results).
+        Returns (scores, row_indices), both (m, k), best first.
+        """
+        return blocked_top_k(self.vectors, queries, k, block_size, exclude)
+
+    def all_neighbors(self, k=10, block_size=DEFAULT_BLOCK_SIZE):
+        """Yield (workout_id, [(neighbor_id, score), ...]) for every row"""
+        for start in range(0, len(self), block_size):
+            queries = np.asarray(self.vectors[start:start + block_size])
+            own_rows = np.arange(start, start + queries.shape[0])
+            scores, rows = self.top_k(queries, k, block_size, exclude=own_rows)
+            for i, row in enumerate(own_rows):
+                yield int(self.ids[row]), [
+                    (int(self.ids[r]), float(s)) for r, s in zip(rows[i], scores[i]) if r >= 0
+                ]
+
+    def similar_pairs(self, threshold=0.95, block_size=DEFAULT_BLOCK_SIZE):
+        """Yield (id_a, id_b, score) for every pair at or above `threshold`.
+
+        Only the upper triangle of the similarity matrix is visited, one
+        (block_size x block_size) tile at a time.
+        """
+        n = len(self)
+        for i in range(0, n, block_size):
+            left = np.asarray(self.vectors[i:i + block_size])
+            for j in range(i, n, block_size):
+                right = np.asarray(self.vectors[j:j + block_size])
+                scores = left @ right.T
+                if i == j:
+                    # Exclude self-pairs and the mirrored lower triangle
+                    scores[np.tril_indices_from(scores)] = -np.inf
+                a, b = np.nonzero(scores >= threshold)
+                for x, y in zip(a, b):
+                    yield int(self.ids[i + x]), int(self.ids[j + y]), float(scores[x, y])
+
+
+class IVFIndex:
+    """Coarse-quantized inverted file index over an EmbeddingSnapshot.
+
+    Rows are clustered with spherical k-means; a query scores only the rows
+    in its `nprobe` closest clusters, trading a little recall for a search
+    cost of roughly nprobe / nlist of the exact scan.
+    """
+
+    def __init__(self, centroids, order, offsets):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, snapshot, nlist=256, iterations=10, sample_size=65536,
+              block_size=DEFAULT_BLOCK_SIZE, seed=0):
+        rng = np.random.default_rng(seed)
+        n = len(snapshot)
+        nlist = min(nlist, n)
+        sample_rows = np.sort(rng.choice(n, size=min(sample_size, n), replace=False))
+        sample = np.asarray(snapshot.vectors[sample_rows])
+
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            # Reseed empty clusters from random sample points
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = _normalize(sums)
+
+        assign = np.empty(n, dtype=np.int32)
+        for start in range(0, n, block_size):
+            block = np.asarray(snapshot.vectors[start:start + block_size])
+            assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        return cls(centroids.astype(np.float32), order, offsets)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, order=self.order, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["centroids"], data["order"], data["offsets"])
+
+    def search(self, snapshot, queries, k=10, nprobe=8):
+        """Approximate top-k; returns (scores, row_indices) like top_k()"""
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        all_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, clusters in enumerate(probes):
+            candidates = np.sort(np.concatenate([
+                self.order[self.offsets[c]:self.offsets[c + 1]] for c in clusters
+            ]))
+            if len(candidates) == 0:
+                continue
+            scores = np.asarray(snapshot.vectors[candidates]) @ queries[q]
+            top = min(k, len(candidates))
+            keep = np.argpartition(-scores, top - 1)[:top]
+            keep = keep[np.argsort(-scores[keep])]
+            all_scores[q, :top] = scores[keep]
+            all_rows[q, :top] = candidates[keep]
+        return all_scores, all_rows
+
+
+def _open_output(path):
+    return open(path, "w") if path else sys.stdout
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline similarity search over workout embeddings")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Stream embeddings from Supabase into a snapshot")
+    export.add_argument("prefix", help="Snapshot path prefix")
+    export.add_argument("--table", choices=sorted(TABLE_COLUMNS), default="external_workouts_new")
+    export.add_argument("--page-size", type=int, default=500)
+
+    query = commands.add_parser("query", help="Top-k similar workouts for one workout ID")
+    query.add_argument("prefix")
+    query.add_argument("--id", type=int, required=True)
+    query.add_argument("--k", type=int, default=10)
+    query.add_argument("--ivf", help="Use an index built with build-ivf")
+    query.add_argument("--nprobe", type=int, default=8)
+
+    dupes = commands.add_parser("dupes", help="All pairs above a similarity threshold")
+    dupes.add_argument("prefix")
+    dupes.add_argument("--threshold", type=float, default=0.97)
+    dupes.add_argument("--out", help="JSON lines output file (default: stdout)")
+
+    neighbors = commands.add_parser("neighbors", help="Top-k similar workouts for every workout")
+    neighbors.add_argument("prefix")
+    neighbors.add_argument("--k", type=int, default=10)
+    neighbors.add_argument("--out", help="JSON lines output file (default: stdout)")
+
+    recall = commands.add_parser("recall", help="Recall@k of reduced/quantized forms against full precision")
+    recall.add_argument("prefix")
+    recall.add_argument("--k", type=int, default=10)
+    recall.add_argument("--queries", type=int, default=500)
+    recall.add_argument("--dimensions", default="full,1024,512,256",
+                        help="Comma-separated dimension counts; 'full' keeps every dimension")
+    recall.add_argument("--forms", default="float32,float16,int8")
+
+    build_ivf = commands.add_parser("build-ivf", help="Build an IVF index next to a snapshot")
+    build_ivf.add_argument("prefix")
+    build_ivf.add_argument("--nlist", type=int, default=256)
+    build_ivf.add_argument("--iterations", type=int, default=10)
+
+    for command in (query, dupes, neighbors, recall, build_ivf):
+        command.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    started = time.perf_counter()
+
+    if args.command == "export":
+        count = export_snapshot(connect_supabase(), args.prefix, args.table, args.page_size)
+        print(f"Wrote {count} embeddings to {args.prefix}.f32", file=sys.stderr)
+
+    elif args.command == "query":
+        snapshot = EmbeddingSnapshot(args.prefix)
+        row = snapshot.position(args.id)
+        query = snapshot.vectors[row]
+        if args.ivf:
+            scores, rows = IVFIndex.load(args.ivf).search(snapshot, query, args.k + 1, args.nprobe)
+        else:
+            scores, rows = snapshot.top_k(query, args.k + 1, args.block_size)
+        results = [(int(snapshot.ids[r]), float(s)) for r, s in zip(rows[0], scores[0]) if r >= 0 and r != row]
+        for workout_id, score in results[:args.k]:
+            print(json.dumps({"id": workout_id, "score": round(score, 6)}))
+
+    elif args.command == "dupes":
+        count = 0
+        out = _open_output(args.out)
+        for a, b, score in EmbeddingSnapshot(args.prefix).similar_pairs(args.threshold, args.block_size):
+            out.write(json.dumps({"id_a": a, "id_b": b, "score": round(score, 6)}) + "\n")
+            count += 1
+        if out is not sys.stdout:
+            out.close()
+        print(f"Found {count} pairs at or above {args.threshold}", file=sys.stderr)
+
+    elif args.command == "neighbors":
+        out = _open_output(args.out)
+        for workout_id, similar in EmbeddingSnapshot(args.prefix).all_neighbors(args.k, args.block_size):
+            out.write(json.dumps({
+                "id": workout_id,
+                "similar": [{"id": n, "score": round(s, 6)} for n, s in similar]
+            }) + "\n")
+        if out is not sys.stdout:
+            out.close()
+
+    elif args.command == "recall":
+        snapshot = EmbeddingSnapshot(args.prefix)
+        dimensions = [None if d == "full" else int(d) for d in args.dimensions.split(",")]
+        forms = args.forms.split(",")
+        print(f"{'dims':>6} {'form':>8} {'recall@' + str(args.k):>10} {'bytes/vec':>10} {'table MB':>9} "
+              f"{'payload':>8} {'ms/query':>9}")
+        for result in recall_benchmark(snapshot, args.k, args.queries, dimensions, forms, args.block_size):
+            print(f"{result['dimensions']:>6} {result['form']:>8} {result['recall']:>10.4f} "
+                  f"{result['bytes_per_vector']:>10} {result['table_mb']:>9.1f} "
+                  f"{result['payload_chars']:>8} {result['ms_per_query']:>9.3f}")
+
+    elif args.command == "build-ivf":
+        snapshot = EmbeddingSnapshot(args.prefix)
+        index = IVFIndex.build(snapshot, args.nlist, args.iterations, block_size=args.block_size)
+        index.save(f"{args.prefix}.ivf.npz")
+        print(f"Wrote {len(index.centroids)}-list index to {args.prefix}.ivf.npz", file=sys.stderr)
+
+    print(f"Done in {time.perf_counter() - started:.2f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
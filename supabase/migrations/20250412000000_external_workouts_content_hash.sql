@@ -0,0 +1,35 @@
+-- Content hash used by crossfitscraper.py to deduplicate workouts.
+-- Must match workout_index.content_hash(): sha256 over the NFC-normalized
+-- title and body joined by a newline, with runs of ASCII whitespace
+-- collapsed to one space and outer spaces trimmed. The class is spelled out
+-- because \s and Python's str.split() disagree on characters like U+00A0.
+alter table "public"."external_workouts" add column if not exists "content_hash" text;
+
+comment on column "public"."external_workouts"."content_hash" is 'sha256 of normalized title and body, used for deduplication';
+
+-- Backfill existing rows. Only the oldest row of any duplicate group gets a
+-- hash so the unique index below can be built.
+update "public"."external_workouts" ew
+set "content_hash" = h.hash
+from (
+    select distinct on (hash) id, hash
+    from (
+        select
+            id,
+            encode(
+                "extensions"."digest"(
+                    btrim(regexp_replace(normalize(coalesce(title, ''), NFC), '[ \t\n\r\f\v]+', ' ', 'g'))
+                    || E'\n' ||
+                    btrim(regexp_replace(normalize(coalesce(body, ''), NFC), '[ \t\n\r\f\v]+', ' ', 'g')),
+                    'sha256'
+                ),
+                'hex'
+            ) as hash
+        from "public"."external_workouts"
+    ) hashed
+    order by hash, id
+) h
+where ew.id = h.id
+  and ew.content_hash is null;
+
+create unique index if not exists "external_workouts_content_hash_key" on "public"."external_workouts" using btree ("content_hash");
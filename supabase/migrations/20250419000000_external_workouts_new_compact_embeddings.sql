@@ -0,0 +1,13 @@
+-- Compact embedding copies written by scripts/reembed-workouts.py --variants.
+-- Columns are left without a fixed dimension so reduced-dimension runs
+-- (--dimensions / --variant-dimensions) fit without another migration.
+-- external_workouts_new is created by create_workouts_with_single_embedding(),
+-- hence the "if exists". On a database where the table only appears after
+-- this migration, re-run these statements; reembed-workouts.py checks for
+-- the columns and refuses to start --variants runs without them.
+alter table if exists "public"."external_workouts_new" add column if not exists "embedding_half" "public"."halfvec";
+
+-- int8 codes, one byte per dimension; value = code * embedding_int8_scale
+alter table if exists "public"."external_workouts_new" add column if not exists "embedding_int8" bytea;
+
+alter table if exists "public"."external_workouts_new" add column if not exists "embedding_int8_scale" real;